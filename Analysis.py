@@ -1,29 +1,38 @@
 # Python includes
-import uproot
 import sys
 import numpy as np
-import scipy as sp
 import pandas as pd
 import logging
 import signal as sg
-from os import path
+from os import path, makedirs
 
-# Custom includes
+# Custom includes. Only the modules needed to schedule the runs and render the heatmaps
+# are imported here. The analysis modules (uproot, numba, scipy, pyplot, ...) are imported
+# when a run is actually analyzed, so a rerun which only re-renders heatmaps starts fast.
 sys.path.insert(0, './NoiseTools/')
-from RawDigits import RawDigit
-from NoiseCalcTools import RMSCalc, PowerCalc, MeanPower, PeakFind
-from NoiseHelperTools import SigintHandler, ReturnConfig#, Decode
-from NoisePlottingTools import PlotRMS, PlotPower, PlotPowerAsHeatmap, PlotWithBackgroundSeparation
-from SpectraTools import BackgroundSNIPCalc
-from DatabaseTools import BuildMapDataFrame
+from NoiseHelperTools import SigintHandler, ReturnConfig, Decode
+from HeatmapTools import PlotHeatmaps
+from OutputTools import WriteMetrics, ReadMetrics
+from Scheduler import RunScheduler
+from CatalogTools import RunCatalog
+from TraceTools import TRACER, Span
+
+def Analyze(Events, cfg, Run, FileName=None):
+    from RawDigits import RawDigit
+    from NoiseCalcTools import NoiseCalc, CrateIndex, PeakFindBatch, ConvergenceMonitor, BinOffset, CorrelationAccumulator
+    from NoisePlottingTools import PlotRMS, PlotPower, PlotWithBackgroundSeparation, PlotCrates
+    from SpectraTools import BackgroundSNIP, SNIPReach
+    from DatabaseTools import BuildMapDataFrame, AlignMap
+    from CacheTools import SpectrumCache, CacheKey, CachedCalc
+    from MetricsDB import MetricsDB
 
-def Decode(File):
-    return None
-
-def Analyze(Events, cfg, Run):
     #Gather data and channel map
+    # The coherent noise subtracted waveforms are either derived from the raw waveforms in
+    # memory ('InProcess') or read from their own producer in the file ('Producer'), e.g.
+    # to validate the former.
+    InProcess = cfg['Analysis']['CoherentNoise'] == 'InProcess'
     RawDigits_Raw = RawDigit(Events, cfg['Path']['DAQName_Raw'])
-    RawDigits_Uncor = RawDigit(Events, cfg['Path']['DAQName_Uncor'])
+    RawDigits_Uncor = RawDigit(Events, cfg['Path']['DAQName_Uncor']) if not InProcess else None
     ChannelList = RawDigits_Raw.GetChannels(0)
     u, c = np.unique(ChannelList, return_counts=True)
     logging.debug('Duplicate channels: ' + str(u[c > 1]))
@@ -31,11 +40,26 @@ def Analyze(Events, cfg, Run):
     logging.debug('ChannelList length: ' + str(len(ChannelList)))
 
     MapExists = path.exists(cfg['Data']['Runs'][Run]+'.csv')
-    if not MapExists: BuildMapDataFrame(ChannelList, Name=cfg['Data']['Runs'][Run])
+    if not MapExists: BuildMapDataFrame(ChannelList, Name=cfg['Data']['Runs'][Run], **cfg['HardwareDB'])
     Dataframe = pd.read_csv(cfg['Data']['Runs'][Run]+'.csv')
     logging.debug('Dataframe shape: ' + str(Dataframe.shape))
     logging.debug('Dataframe head: ' + str(Dataframe.head))
 
+    # Whole mini-crates can be masked in the configuration. Their channels are dropped by
+    # the RawDigits before any arithmetic is done and removed from the channel map.
+    MaskedCrates = cfg['Data']['MaskedCrates'] or []
+    if len(MaskedCrates) > 0:
+        IsMasked = Dataframe.fCrate.isin(MaskedCrates).to_numpy()
+        logging.debug('Masking crates ' + str(MaskedCrates) + ' (' + str(IsMasked.sum()) + ' channels).')
+        RawDigits_Raw.ExcludeChannels(Dataframe.fID[IsMasked].to_numpy())
+        if not InProcess: RawDigits_Uncor.ExcludeChannels(Dataframe.fID[IsMasked].to_numpy())
+        Dataframe = Dataframe[~IsMasked].reset_index(drop=True)
+        ChannelList = RawDigits_Raw.GetChannels(0)
+
+    # The rows of the map must follow the channels of the waveforms, which the crate and
+    # readout board grouping (CrateIndex) relies on.
+    Dataframe = AlignMap(Dataframe, ChannelList)
+
     #Temp Debugging
     MiniCrateList = Dataframe.fCrate.unique()
     for MiniCrate in MiniCrateList:
@@ -45,62 +69,115 @@ def Analyze(Events, cfg, Run):
         logging.debug('Duplicate channels: ' + str(u2[c2 > 1]))
         logging.debug('Duplicate channel counts: ' + str(c2[c2 > 1]))
 
-    #Calculate RMS for each channel
-    RMSRaw = RMSCalc(RawDigits_Raw, NumEvents=cfg['Analysis']['Events'])
-    RMSUncor = RMSCalc(RawDigits_Uncor, NumEvents=cfg['Analysis']['Events'])
+    #Calculate RMS and the power spectrum for each channel in a single pass over each producer
+    Source = (FileName, cfg['Path']['RecoFolder']) if FileName is not None else None
+    CalcOptions = {'NumEvents': cfg['Analysis']['Events'], 'ChunkSize': cfg['Analysis']['ChunkSize'], 'Workers': cfg['Analysis']['Workers'], 'Source': Source,
+                   'Engine': cfg['Analysis']['SpectrumEngine'], 'BlockSize': cfg['Analysis']['BlockSize'], 'MemoryGB': cfg['Analysis']['WorkerMemoryGB']}
+    # In the 'Band' spectrum mode only the bins from fLow to fHigh (padded on either side by
+    # BandPadding kHz, but at least by the reach of the 20 SNIP iterations, for the SNIP
+    # background) are kept, which is all the heatmaps and the per-crate metrics need. The
+    # spectrum plots then only show this window.
+    BandMode = cfg['Analysis']['SpectrumMode'] == 'Band'
+    if BandMode:
+        CalcOptions['Band'] = (cfg['Analysis']['fLow'], cfg['Analysis']['fHigh'])
+        CalcOptions['Padding'] = cfg['Analysis']['BandPadding']
+        CalcOptions['Reach'] = SNIPReach(20)
+    # The results for each producer are cached on disk, so re-analyzing a run (e.g. with a
+    # different fLow/fHigh or SNIP settings) only needs to redo the later stages.
+    Cache = None
+    if cfg['Cache']['Enabled'] and FileName is not None: Cache = SpectrumCache(cfg['Cache']['Path'], cfg['Cache']['QuotaGB'])
+    Names = ['RMS', 'Frequency', 'Spectrum']
+    Key = lambda RawDigits, **Options : CacheKey(FileName, RawDigits.Producer, cfg['Analysis']['Events'], Engine=CalcOptions['Engine'],
+                                                 Masked=sorted(MaskedCrates), Window=(CalcOptions['Band'], CalcOptions['Padding'], CalcOptions['Reach']) if BandMode else None,
+                                                 **Options) if Cache is not None else None
+    Crates = CrateIndex(Dataframe)
+
+    # The number of events averaged is either fixed (Events) or chosen adaptively, stopping
+    # once the RMS of each channel and the band power of each mini-crate have converged (see
+    # ConvergenceMonitor). It is cached along with the results of the raw producer.
+    Convergence = ConvergenceMonitor(Crates.Matrix, cfg['Analysis']['fLow'], cfg['Analysis']['fHigh'], **cfg['Analysis']['Convergence'])
+    Adaptive = {'Convergence': sorted(cfg['Analysis']['Convergence'].items()), 'Band': (cfg['Analysis']['fLow'], cfg['Analysis']['fHigh'])} if Convergence.Tolerance is not None else dict()
+
+    # The correlations of the channels within each mini-crate can be accumulated from the
+    # raw waveforms as well (see CorrelationAccumulator). Their per-crate summary is cached
+    # with the results of the raw producer, and the matrices are written to an npz file.
+    CorrelationCfg = cfg['Analysis']['Correlation']
+    Correlation = CorrelationAccumulator(Crates) if CorrelationCfg['Enabled'] else None
+    RawNames = ['Events'] + (['CorrMean', 'CorrBoard', 'CoherentFrac'] if Correlation is not None else [])
+    RawOptions = dict(Adaptive, Correlation=True) if Correlation is not None else Adaptive
+    def Calc(RawDigits, IsRaw, **Options):
+        Results = NoiseCalc(RawDigits, IsRaw, Convergence=Convergence, Correlation=Correlation, **Options) + (np.array([Convergence.N]),)
+        if Correlation is None: return Results
+        if CorrelationCfg['Path'] is not None:
+            makedirs(CorrelationCfg['Path'], exist_ok=True)
+            Correlation.Save(CorrelationCfg['Path'] + 'Correlation_Run' + str(Run) + '.npz', IDs=Dataframe.fID.to_numpy())
+        return Results + Correlation.Summary()
+    if InProcess:
+        Results = CachedCalc(Cache, Key(RawDigits_Raw, Coherent='InProcess', **RawOptions), Names + ['UnRMS', 'UnSpectrum'] + RawNames,
+                             Calc, RawDigits_Raw, True, Groups=Crates.Boards(), **CalcOptions)
+        RMSRaw, Frequency, PowerRaw, RMSUncor, PowerUncor, nEvents = Results[:6]
+        CrateCorrelation = Results[6:]
+    else:
+        # The coherent noise subtracted producer is averaged over as many events as the raw.
+        Results = CachedCalc(Cache, Key(RawDigits_Raw, **RawOptions), Names + RawNames, Calc, RawDigits_Raw, True, **CalcOptions)
+        RMSRaw, Frequency, PowerRaw, nEvents = Results[:4]
+        CrateCorrelation = Results[4:]
+        CalcOptions['NumEvents'] = int(nEvents[0])
+        RMSUncor, Frequency, PowerUncor = CachedCalc(Cache, Key(RawDigits_Uncor, Events=int(nEvents[0])), Names, NoiseCalc, RawDigits_Uncor, True, **CalcOptions)
+    nEvents = int(nEvents[0])
+    logging.info('Run ' + str(Run) + ': averaged ' + str(nEvents) + ' events.')
+    print('Run ' + str(Run) + ': averaged ' + str(nEvents) + ' events.')
     RMSData = {'fID': ChannelList, 'fRMS': RMSRaw, 'fUnRMS': RMSUncor}
     tmp = pd.DataFrame(RMSData)
     Dataframe = Dataframe.merge(tmp, on='fID', how='left')
     
     #Plot RMS
-    MiniCrateList = Dataframe.fCrate.unique()
-    for MiniCrate in MiniCrateList:
-        Selection = Dataframe.loc[ Dataframe['fCrate'] == MiniCrate ]
-        PlotRMS(Selection, MiniCrate, cfg['Path']['Images'])
-
-    #Calculate the power spectrum for each channel
-    Frequency, PowerRaw = PowerCalc(RawDigits_Raw, True, NumEvents=cfg['Analysis']['Events'])
-    Frequency, PowerUncor = PowerCalc(RawDigits_Uncor, True, NumEvents=cfg['Analysis']['Events'])
+    Images = cfg['Path']['Images']
+    PlotJobs = [ (PlotRMS, (Dataframe.iloc[ Crates.Channels(MiniCrate) ], MiniCrate, Images)) for MiniCrate in Crates.Crates ]
 
     #Plot power spectrums for each mini-crate
-    for MiniCrate in MiniCrateList:
-        PlotPower(Frequency, PowerRaw, PowerUncor, Dataframe, MiniCrate, cfg['Path']['Images'])
-
-    #Locate peak frequency and associated power for each mini-crate
-    PowerDict = {'fCrate': [], 'fFreq': [], 'fPow': [], 'fPowSep': [], 'fPowBack': [], 'fRatio': []}
-    for MiniCrate in MiniCrateList:
-        PowerRaw_Selected = MeanPower(PowerRaw, Dataframe, MiniCrate)
-        PowerUncor_Selected = MeanPower(PowerUncor, Dataframe, MiniCrate)
-        fFreq, fPow, ArgMax = PeakFind(Frequency, PowerRaw_Selected, cfg['Analysis']['fLow'], cfg['Analysis']['fHigh'])
-        Background = BackgroundSNIPCalc(PowerRaw_Selected, nIterations=20, ApplyLLS=True)
-        PlotWithBackgroundSeparation(Frequency, PowerRaw_Selected, Background, MiniCrate, Path=cfg['Path']['Images'], Suffix='')
-        fPowSep = (PowerRaw_Selected - Background)[ArgMax]
-        fPowBG = Background[ArgMax]
-        fRatio = fPowSep / fPowBG
-        PowerDict['fCrate'].append(MiniCrate)
-        PowerDict['fFreq'].append(fFreq)
-        PowerDict['fPow'].append(fPow)
-        PowerDict['fPowSep'].append(fPowSep)
-        PowerDict['fPowBack'].append(fPowBG)
-        PowerDict['fRatio'].append(fRatio)
-    PowerFrame = pd.DataFrame(PowerDict)
+    PowerRaw_Crates = Crates.MeanPower(PowerRaw, 'Raw')
+    PowerUncor_Crates = Crates.MeanPower(PowerUncor, 'Uncor')
+    PlotSpectra = cfg['Plotting']['Spectra']
+    if PlotSpectra:
+        for MiniCrate, PowerRaw_Selected, PowerUncor_Selected in zip(Crates.Crates, PowerRaw_Crates, PowerUncor_Crates):
+            PlotJobs.append((PlotPower, (Frequency, PowerRaw_Selected, PowerUncor_Selected, MiniCrate, Images)))
+
+    #Locate peak frequency and associated power for each mini-crate. The SNIP background
+    #protects the lowest bins of the full spectrum, so it is told where a band starts.
+    Offset = BinOffset(Frequency)
+    Background_Crates = BackgroundSNIP(PowerRaw_Crates, nIterations=20, ApplyLLS=True, Offset=Offset)
+    if PlotSpectra:
+        for MiniCrate, PowerRaw_Selected, Background in zip(Crates.Crates, PowerRaw_Crates, Background_Crates):
+            PlotJobs.append((PlotWithBackgroundSeparation, (Frequency, PowerRaw_Selected, Background, MiniCrate, Images)))
+    PlotCrates(PlotJobs, Workers=cfg['Plotting']['Workers'], SavePNG=cfg['Plotting']['SavePNG'])
+    PowerFrame = PeakFindBatch(Frequency, PowerRaw_Crates, cfg['Analysis']['fLow'], cfg['Analysis']['fHigh'], Background=Background_Crates)
+    PowerFrame.insert(0, 'fCrate', Crates.Crates)
+    PowerFrame.insert(0, 'fRun', Run)
+    PowerFrame['fEvents'] = nEvents
+    for Column, Values in zip(['fCorrMean', 'fCorrBoard', 'fCoherentFrac'], CrateCorrelation): PowerFrame[Column] = Values
+    PowerFrame = PowerFrame.drop(columns='fArg')
     
-    # Locate the peak frequency and associated power for each channel
-    ChannelPowerDict = {'fID': ChannelList, 'fFreq': [], 'fPow': [], 'fPowSep': [], 'fPowBack': [], 'fRatio': []}
-    for n, PowerSpectrum in enumerate(PowerRaw):
-        fFreq, fPow, ArgMax = PeakFind(Frequency, PowerSpectrum, cfg['Analysis']['fLow'], cfg['Analysis']['fHigh'])
-        Background = BackgroundSNIPCalc(PowerSpectrum, nIterations=20, ApplyLLS=True)
-        fPowSep = (PowerSpectrum - Background)[ArgMax]
-        fPowBG = Background[ArgMax]
-        fRatio = fPowSep / fPowBG
-        ChannelPowerDict['fFreq'].append(fFreq)
-        ChannelPowerDict['fPow'].append(fPow)
-        ChannelPowerDict['fPowSep'].append(fPowSep)
-        ChannelPowerDict['fPowBack'].append(fPowBG)
-        ChannelPowerDict['fRatio'].append(fRatio)
-    ChannelPowerFrame = pd.DataFrame(ChannelPowerDict)
+    # Locate the peak frequency and associated power for each channel. The backgrounds and
+    # peaks of all channels are found at once.
+    Backgrounds = BackgroundSNIP(PowerRaw, nIterations=20, ApplyLLS=True, Offset=Offset)
+    ChannelPowerFrame = PeakFindBatch(Frequency, PowerRaw, cfg['Analysis']['fLow'], cfg['Analysis']['fHigh'], Background=Backgrounds)
+    ChannelPowerFrame.insert(0, 'fID', ChannelList)
+    ChannelPowerFrame = ChannelPowerFrame.drop(columns='fArg')
+    del Backgrounds
     Dataframe = Dataframe.merge(ChannelPowerFrame, on='fID', how='left')
-    Dataframe.to_csv('MetricsByChannel_' + str(Run) + '.csv', index=False)
+    Dataframe.insert(0, 'fRun', Run)
+
+    # The per-channel and per-crate metrics are written to the columnar metrics store.
+    WriteMetrics(Dataframe, cfg['Output']['Path'], 'ChannelMetrics')
+    WriteMetrics(PowerFrame, cfg['Output']['Path'], 'CrateMetrics')
+
+    # The metrics are also indexed in the metrics database for trend queries across runs.
+    if cfg['Output']['Database'] is not None:
+        Database = MetricsDB(cfg['Output']['Database'])
+        Database.Insert('ChannelMetrics', Dataframe)
+        Database.Insert('CrateMetrics', PowerFrame)
+        Database.Close()
     print(Dataframe.head())
 
     return PowerFrame
@@ -112,44 +189,51 @@ def main():
     logging.basicConfig(filename=cfg['Miscellaneous']['LogPath'] + cfg['Miscellaneous']['LogName'], level=logging.DEBUG, filemode='w')
     logging.warning('Logging service has started.')
 
-    # Connect to ROOT file
-
-    FullPower = pd.DataFrame()
-    for Run in cfg['Data']['Runs']:
-        Map = cfg['Data']['Runs'][Run]
-        FileToProcess = None
-        if cfg['Analysis']['FromFile']:
-            FileToProcess = cfg['Data']['Files'][Run]
-        else:
-            FileToProcess = Decode(str(Run))
-        Data = uproot.open(FileToProcess)
-        Events = Data[cfg['Path']['RecoFolder']]
-        Power = Analyze(Events, cfg, Run)
-        FullPower = FullPower.append(Power)
-        Power.to_csv(cfg['Path']['Images']+'Run'+str(Run)+'Power.csv', index=False)
-
-    for Run in cfg['Data']['AnalyzedRuns']:
-        Power = pd.read_csv(cfg['Path']['Images']+'Run'+str(Run)+'Power.csv')
-        FullPower = FullPower.append(Power)
-    FullPower.to_csv('FullPower.csv', index=False)
+    # The decoded file for each run is either given in the configuration or produced by a
+    # decode job. Decoding the next runs is overlapped with the analysis of the current one.
+    # The files of each run and their decoded files are kept in the run catalog.
+    Catalog = RunCatalog(cfg['Catalog']['Path'], MaxAge=cfg['Catalog']['MaxAge']) if not cfg['Analysis']['FromFile'] else None
+    def Source(Run):
+        if cfg['Analysis']['FromFile']: return cfg['Data']['Files'][Run]
+        return Decode(str(Run), Command=cfg['Scheduler']['DecodeCommand'], Events=cfg['Analysis']['Events'], Catalog=Catalog)
+
+    # Connect to ROOT file. If tracing is enabled, the stages of the analysis of each run
+    # are recorded and written to a trace file for the run (see TraceTools).
+    Trace = cfg['Trace']
+    def Process(Run, FileToProcess):
+        if Trace['Enabled']: TRACER.Start(Profile=Trace['Profile'], ProfilePath=Trace['Path'], Run=Run, File=FileToProcess)
+        try:
+            with Span('Analyze', Run=Run):
+                with Span('Open'):
+                    import uproot
+                    Data = uproot.open(FileToProcess)
+                    Events = Data[cfg['Path']['RecoFolder']]
+                return Analyze(Events, cfg, Run, FileName=FileToProcess)
+        finally:
+            if Trace['Enabled']:
+                TRACER.Save(Trace['Path'] + 'Trace_Run' + str(Run) + '.json')
+                TRACER.Stop()
+
+    Runs = list(cfg['Data']['Runs'])
+    Scheduler = RunScheduler(Source, Process, StateFile=cfg['Scheduler']['StateFile'], DecodeWorkers=cfg['Scheduler']['DecodeWorkers'],
+                             Lookahead=cfg['Scheduler']['Lookahead'])
+    Results = Scheduler.Run(Runs)
+    if len(Scheduler.Failed(Runs)) > 0: print('Failed runs: ' + str(Scheduler.Failed(Runs)))
+    FullPower = list(Results.values())
+
+    # Runs which have already been analyzed (including those completed in a previous pass)
+    # are read back from the metrics store, reading only the columns needed for the heatmaps.
+    Analyzed = list(cfg['Data']['AnalyzedRuns']) + [ Run for Run in Scheduler.Completed(Runs) if Run not in Results ]
+    if len(Analyzed) > 0:
+        Columns = ['fRun', 'fCrate'] + cfg['SVGHeatmap']['Columns']
+        FullPower.append(ReadMetrics(cfg['Output']['Path'], 'CrateMetrics', Columns=Columns, Runs=Analyzed))
+    if len(FullPower) == 0: return
+    FullPower = pd.concat(FullPower, ignore_index=True)
 
     # Plot the power in a geographically relevant heatmap. The config field Columns
     # specifies a list of columns to produce a plot for, so we produce a plot for
-    # each request column.
-    
-    for i in range(len(cfg['SVGHeatmap']['Columns'])):
-        Tag = cfg['SVGHeatmap']['Columns'][i]
-        ZMin = cfg['SVGHeatmap']['ZMin'][i]
-        ZMax = cfg['SVGHeatmap']['ZMax'][i]
-        BarLabel = cfg['SVGHeatmap']['BarLabel'][i]
-        PlotPowerAsHeatmap(PowerFrame,
-                           Tag,
-                           cfg['SVGHeatmap']['Gradient'],
-                           cfg['SVGHeatmap']['SVGBase'],
-                           BarLabel,
-                           ZMin=ZMin,
-                           ZMax=ZMax,
-                           EmptyColor=cfg['SVGHeatmap']['EmptyColor'])
+    # each request column (and for each run if requested).
+    PlotHeatmaps(FullPower, cfg['SVGHeatmap'], Path=cfg['SVGHeatmap']['Path'], PerRun=cfg['SVGHeatmap']['PerRun'])
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,155 @@
+# Python includes
+import sys
+import os
+import time
+import json
+import argparse
+import resource
+import threading
+import subprocess
+import tempfile
+import numpy as np
+
+# Custom includes
+sys.path.insert(0, './NoiseTools/')
+from RawDigits import RawDigit
+from NoiseCalcTools import NoiseCalc, CrateIndex, PeakFindBatch, BinOffset, CorrelationAccumulator
+from NoisePlottingTools import PlotRMS, PlotPower, PlotWithBackgroundSeparation, PlotCrates
+from SpectraTools import BackgroundSNIPCalcBatch, SNIPReach
+from SyntheticTools import SyntheticEvents, SyntheticMap
+from TraceTools import CurrentRSS
+
+class Stage:
+    """
+    Stage: Context manager timing one stage of the benchmark. It records the wall and CPU time of the stage and the
+    peak resident set size while it ran, which is sampled by a background thread.
+    """
+    def __init__(self, Results, Name, Events=0, Channels=0, Interval=0.01):
+        """
+        args: Results is the dictionary the measurements of the stage are added to under Name
+              Events and Channels are the number of events and channels processed, for the rates
+              Interval is the time in seconds between samples of the resident set size
+        """
+        self.Results  = Results
+        self.Name     = Name
+        self.Events   = Events
+        self.Channels = Channels
+        self.Interval = Interval
+
+    def Sample(self):
+        while not self.Done.wait(self.Interval):
+            self.PeakRSS = max(self.PeakRSS, CurrentRSS())
+
+    def __enter__(self):
+        self.PeakRSS = CurrentRSS()
+        self.Done    = threading.Event()
+        self.Thread  = threading.Thread(target=self.Sample, daemon=True)
+        self.Thread.start()
+        self.Wall    = time.perf_counter()
+        self.CPU     = time.process_time()
+        return self
+
+    def __exit__(self, *Exception):
+        Wall = time.perf_counter() - self.Wall
+        CPU  = time.process_time() - self.CPU
+        self.Done.set()
+        self.Thread.join()
+        self.PeakRSS = max(self.PeakRSS, CurrentRSS())
+        self.Results[self.Name] = {'Wall': Wall, 'CPU': CPU, 'PeakRSS': self.PeakRSS}
+        if self.Events > 0: self.Results[self.Name]['EventsPerSecond'] = self.Events / Wall
+        if self.Channels > 0: self.Results[self.Name]['ChannelsPerSecond'] = self.Channels / Wall
+
+def Commit():
+    # The commit being benchmarked, so results can be compared from commit to commit.
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True, cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except OSError:
+        return None
+
+def Benchmark(Args):
+    # Runs each stage of Analyze() on a synthetic data set and returns the measurements. The
+    # stages are timed separately: reading the waveforms, the RMS and spectra (raw and with
+    # the coherent noise removed in memory), the crate-mean spectra, the SNIP backgrounds and
+    # peak finding of the crates and of the channels, and the plots of every crate.
+    Events = SyntheticEvents(nChannels=Args.channels, nTicks=Args.ticks, nEvents=Args.events, Seed=Args.seed)
+    Stages = dict()
+    nChannels = Args.channels * Args.events
+    Band = {'Band': (Args.flow, Args.fhigh), 'Padding': Args.padding, 'Reach': SNIPReach(20)} if Args.mode == 'Band' else dict()
+
+    # The numba kernels are compiled on first use. A tiny data set is run through them
+    # first so that the compilation isn't counted in the stages.
+    if not Args.nowarmup:
+        with Stage(Stages, 'Warmup'):
+            Small = SyntheticEvents(nChannels=128, nTicks=256, nEvents=1)
+            Small = NoiseCalc(RawDigit(Small, 'Warmup'), True, 1, Engine=Args.engine)[2]
+            for DType in (np.float32, np.float64): BackgroundSNIPCalcBatch(Small.astype(DType), nIterations=20, ApplyLLS=True, Offset=1)
+
+    with Stage(Stages, 'Setup'):
+        RawDigits = RawDigit(Events, 'raw::RawDigits_daqTPC_RAW_decode.')
+        Crates = CrateIndex(SyntheticMap(Events))
+    with Stage(Stages, 'Read', Args.events, nChannels):
+        for EventNum, Waveforms in RawDigits.IterateWaveforms(Args.events, Args.chunk): pass
+    with Stage(Stages, 'NoiseCalc', Args.events, nChannels):
+        RMS, Frequency, Power, UnRMS, UnPower = NoiseCalc(RawDigits, True, Args.events, Args.chunk, Groups=Crates.Boards(), Engine=Args.engine, BlockSize=Args.block, **Band)
+        Offset = BinOffset(Frequency)
+    if Args.correlation:
+        # The waveforms are read again, so the Read stage should be subtracted from this one.
+        with Stage(Stages, 'Correlation', Args.events, nChannels):
+            Correlation = CorrelationAccumulator(Crates)
+            for EventNum, Waveforms in RawDigits.IterateWaveforms(Args.events, Args.chunk): Correlation.Update(Waveforms)
+            Correlation.Summary()
+    with Stage(Stages, 'CrateMeanPower'):
+        PowerCrates = Crates.MeanPower(Power, 'Raw')
+        UnPowerCrates = Crates.MeanPower(UnPower, 'Uncor')
+    with Stage(Stages, 'CrateSNIP'):
+        Background = BackgroundSNIPCalcBatch(PowerCrates, nIterations=20, ApplyLLS=True, Offset=Offset)
+    with Stage(Stages, 'CratePeakFind'):
+        PeakFindBatch(Frequency, PowerCrates, Args.flow, Args.fhigh, Background=Background)
+    with Stage(Stages, 'ChannelSNIP', 0, Args.channels):
+        Backgrounds = BackgroundSNIPCalcBatch(Power, nIterations=20, ApplyLLS=True, Offset=Offset)
+    with Stage(Stages, 'ChannelPeakFind', 0, Args.channels):
+        PeakFindBatch(Frequency, Power, Args.flow, Args.fhigh, Background=Backgrounds)
+    if not Args.noplots:
+        Map = SyntheticMap(Events).assign(fRMS=RMS, fUnRMS=UnRMS)
+        with tempfile.TemporaryDirectory() as Images, Stage(Stages, 'Plotting'):
+            Images += '/'
+            Jobs = [ (PlotRMS, (Map.iloc[ Crates.Channels(MiniCrate) ], MiniCrate, Images)) for MiniCrate in Crates.Crates ]
+            Jobs += [ (PlotPower, (Frequency, Raw, Uncor, MiniCrate, Images)) for MiniCrate, Raw, Uncor in zip(Crates.Crates, PowerCrates, UnPowerCrates) ]
+            Jobs += [ (PlotWithBackgroundSeparation, (Frequency, Raw, Back, MiniCrate, Images)) for MiniCrate, Raw, Back in zip(Crates.Crates, PowerCrates, Background) ]
+            PlotCrates(Jobs, Workers=Args.plotworkers)
+
+    return {'Commit': Commit(),
+            'Time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'Parameters': vars(Args),
+            'Total': {'Wall': sum([ x['Wall'] for Name, x in Stages.items() if Name != 'Warmup' ]),
+                      'PeakRSS': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024},
+            'Stages': Stages}
+
+def main():
+    Parser = argparse.ArgumentParser(description='Benchmark the stages of the noise analysis on synthetic RawDigits.')
+    Parser.add_argument('--channels', type=int, default=4608, help='number of channels per event')
+    Parser.add_argument('--ticks', type=int, default=4096, help='number of ticks per waveform')
+    Parser.add_argument('--events', type=int, default=10, help='number of events')
+    Parser.add_argument('--chunk', type=int, default=5, help='number of events read at once')
+    Parser.add_argument('--engine', default='periodogram', help='spectrum engine (periodogram or rfft)')
+    Parser.add_argument('--mode', default='Full', choices=['Full', 'Band'], help='keep the full spectrum or only the padded band')
+    Parser.add_argument('--padding', type=float, default=150, help='padding of the band on either side in kHz')
+    Parser.add_argument('--block', type=int, default=1024, help='block size of the rfft engine')
+    Parser.add_argument('--flow', type=float, default=100, help='lower edge of the peak search in kHz')
+    Parser.add_argument('--fhigh', type=float, default=130, help='upper edge of the peak search in kHz')
+    Parser.add_argument('--plotworkers', type=int, default=1, help='number of plotting processes')
+    Parser.add_argument('--noplots', action='store_true', help='skip the plotting stage')
+    Parser.add_argument('--correlation', action='store_true', help='also time the per-crate channel correlations')
+    Parser.add_argument('--nowarmup', action='store_true', help='include the numba compilation in the stages')
+    Parser.add_argument('--seed', type=int, default=0, help='seed of the synthetic data')
+    Parser.add_argument('--output', default='Benchmark.json', help='JSON file the results are written to')
+    Args = Parser.parse_args()
+
+    Results = Benchmark(Args)
+    with open(Args.output, 'w') as Output:
+        json.dump(Results, Output, indent=2)
+    for Name, Measurement in Results['Stages'].items():
+        print('{:<16} {:>9.3f} s {:>9.1f} MB'.format(Name, Measurement['Wall'], Measurement['PeakRSS'] / 1024**2))
+
+if __name__ == "__main__":
+    main()
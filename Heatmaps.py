@@ -0,0 +1,33 @@
+# Python includes
+import sys
+import logging
+import argparse
+
+# Custom includes. Only the metrics store and the heatmaps are needed, so none of the
+# analysis modules (uproot, numba, scipy, pyplot) are imported.
+sys.path.insert(0, './NoiseTools/')
+from NoiseHelperTools import ReturnConfig
+from OutputTools import ReadMetrics
+from HeatmapTools import PlotHeatmaps
+
+def main():
+    # Re-renders the heatmaps from the per-crate metrics already in the metrics store,
+    # without analyzing any run. By default the runs of the configuration (Runs and
+    # AnalyzedRuns) are used, or the runs given on the command line.
+    Parser = argparse.ArgumentParser(description='Render the heatmaps of analyzed runs from the metrics store.')
+    Parser.add_argument('runs', type=int, nargs='*', help='runs to include (default: the runs in the configuration)')
+    Parser.add_argument('--config', default='TPCConfig.yaml', help='configuration file')
+    Args = Parser.parse_args()
+
+    cfg = ReturnConfig(Args.config)
+    logging.basicConfig(filename=cfg['Miscellaneous']['LogPath'] + 'Heatmaps' + cfg['Miscellaneous']['LogName'], level=logging.DEBUG, filemode='w')
+    Runs = Args.runs if len(Args.runs) > 0 else list(cfg['Data']['Runs']) + list(cfg['Data']['AnalyzedRuns'])
+    Columns = ['fRun', 'fCrate'] + cfg['SVGHeatmap']['Columns']
+    PowerFrame = ReadMetrics(cfg['Output']['Path'], 'CrateMetrics', Columns=Columns, Runs=Runs)
+    if len(PowerFrame) == 0:
+        print('No metrics found for runs ' + str(Runs))
+        return
+    PlotHeatmaps(PowerFrame, cfg['SVGHeatmap'], Path=cfg['SVGHeatmap']['Path'], PerRun=cfg['SVGHeatmap']['PerRun'])
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,93 @@
+import numpy as np
+import os
+import time
+import shutil
+import hashlib
+import logging
+
+# The version of the noise calculation. This is part of every cache key, so it should be
+# incremented whenever a change to the calculation would alter its results.
+CALCVERSION = 1
+
+def CacheKey(FileName, Producer, NumEvents, **Options):
+    # This function builds the key under which the results of a calculation are cached.
+    # The input file is identified by its absolute path, size, and modification time, so a
+    # re-decoded file with the same name is not mistaken for the old one. Any Options that
+    # change the results of the calculation (e.g. the spectrum engine) are included too.
+    Stat = os.stat(FileName)
+    Identity = [ os.path.abspath(FileName), Stat.st_size, int(Stat.st_mtime), Producer, NumEvents, CALCVERSION ]
+    Identity += sorted(Options.items())
+    return hashlib.sha1(repr(Identity).encode()).hexdigest()
+
+class SpectrumCache:
+    """
+    SpectrumCache: An on-disk cache of the per-producer results (RMS, frequencies, averaged power spectra) of the
+    noise calculation. Each entry is a directory named by its key holding one .npy file per array, which are loaded
+    back as memory maps. The least recently used entries are evicted to keep the cache under a disk quota.
+    """
+    def __init__(self, Path, QuotaGB=50):
+        """
+        args: Path is the directory holding the cache entries
+              QuotaGB is the maximum total size of the cache in GB
+        """
+        self.Path  = Path
+        self.Quota = QuotaGB * 1024**3
+        os.makedirs(self.Path, exist_ok=True)
+
+    def Load(self, Key, Names):
+        # Returns the cached arrays (as read-only memory maps) in the order of Names, or None
+        # if there is no complete entry for the key. Loading an entry marks it as recently
+        # used.
+        Entry = os.path.join(self.Path, Key)
+        if not os.path.isdir(Entry): return None
+        try:
+            Arrays = [ np.load(os.path.join(Entry, Name + '.npy'), mmap_mode='r') for Name in Names ]
+        except (OSError, ValueError):
+            logging.warning('[ SpectrumCache ]: Unreadable cache entry ' + Key + '. Ignoring it.')
+            return None
+        os.utime(Entry)
+        logging.debug('[ SpectrumCache ]: Loaded cache entry ' + Key)
+        return Arrays
+
+    def Store(self, Key, Names, Arrays):
+        # The arrays are written to a temporary directory which is then renamed into place,
+        # so an interrupted write never leaves a partial entry behind.
+        Entry = os.path.join(self.Path, Key)
+        Temporary = Entry + '.tmp' + str(os.getpid())
+        os.makedirs(Temporary, exist_ok=True)
+        for Name, Array in zip(Names, Arrays):
+            if Array is not None: np.save(os.path.join(Temporary, Name + '.npy'), Array)
+        if os.path.isdir(Entry): shutil.rmtree(Entry)
+        os.rename(Temporary, Entry)
+        logging.debug('[ SpectrumCache ]: Stored cache entry ' + Key)
+        self.Evict(Keep=Key)
+
+    def Evict(self, Keep=None):
+        # Remove the least recently used entries until the cache is under its quota. The
+        # entry given by Keep (usually the one just written) is never removed.
+        Entries = list()
+        for Key in os.listdir(self.Path):
+            Entry = os.path.join(self.Path, Key)
+            if not os.path.isdir(Entry) or '.tmp' in Key: continue
+            Size = sum([ os.path.getsize(os.path.join(Entry, x)) for x in os.listdir(Entry) ])
+            Entries.append((os.path.getmtime(Entry), Size, Key))
+        Total = sum([ x[1] for x in Entries ])
+        for Time, Size, Key in sorted(Entries):
+            if Total <= self.Quota: break
+            if Key == Keep: continue
+            shutil.rmtree(os.path.join(self.Path, Key))
+            Total -= Size
+            logging.debug('[ SpectrumCache ]: Evicted cache entry ' + Key)
+
+def CachedCalc(Cache, Key, Names, Function, *Args, **Kwargs):
+    # This function returns the cached results for the key if there are any, otherwise it
+    # calls Function(*Args, **Kwargs), stores its results (a tuple of arrays matching Names)
+    # and returns them. If Cache is None the function is simply called.
+    if Cache is not None:
+        Cached = Cache.Load(Key, Names)
+        if Cached is not None: return tuple(Cached)
+    Start = time.time()
+    Results = Function(*Args, **Kwargs)
+    logging.debug('[ CachedCalc() ]: Calculation took ' + str(time.time() - Start) + ' s.')
+    if Cache is not None: Cache.Store(Key, Names, Results)
+    return Results
@@ -0,0 +1,131 @@
+import os
+import json
+import time
+import glob
+import logging
+import threading
+
+class SAMWebBackend:
+    """
+    SAMWebBackend: Looks up the files of a run and their locations in Samweb. A single client is created on first use
+    and shared by every lookup.
+    """
+    def __init__(self, Experiment='icarus'):
+        """
+        args: Experiment is the experiment whose files are looked up
+        """
+        self.Experiment = Experiment
+        self.Client     = None
+
+    def Connect(self):
+        if self.Client is None:
+            import samweb_client
+            self.Client = samweb_client.SAMWebClient(experiment=self.Experiment)
+        return self.Client
+
+    def ListFiles(self, Run):
+        # Returns the names of the data files of the run.
+        return [ str(x) for x in self.Connect().listFiles('run_number=' + str(Run)) ]
+
+    def LocateFile(self, Name):
+        # Returns the directory holding the file. Samweb returns locations of the form
+        # 'storage:/path/to/directory'.
+        return self.Connect().locateFile(Name)[0]['full_path'].split(':')[1]
+
+class FakeBackend:
+    """
+    FakeBackend: A local stand-in for Samweb (e.g. for testing) which serves the files of each run and their locations
+    from a dictionary. The number of lookups is counted so tests can check which lookups reached the backend.
+    """
+    def __init__(self, Runs):
+        """
+        args: Runs is a dictionary mapping each run to a dictionary of its file names and their directories
+        """
+        self.Runs    = { str(Run): Files for Run, Files in Runs.items() }
+        self.Lookups = 0
+
+    def ListFiles(self, Run):
+        self.Lookups += 1
+        return list(self.Runs.get(str(Run), dict()).keys())
+
+    def LocateFile(self, Name):
+        self.Lookups += 1
+        for Files in self.Runs.values():
+            if Name in Files: return Files[Name]
+        raise KeyError('Unknown file ' + Name)
+
+class RunCatalog:
+    """
+    RunCatalog: A persistent catalog of the data files of each run, their locations, and the path of the decoded file
+    of each run. Lookups are served from the catalog and only reach the backend (e.g. Samweb) when the entry for a
+    run is missing or older than MaxAge.
+    """
+    def __init__(self, Path='RunCatalog.json', Backend=None, MaxAge=86400):
+        """
+        args: Path is the JSON file holding the catalog
+              Backend is the lookup backend (SAMWebBackend if None)
+              MaxAge is the time in seconds after which the file list and locations of a run are looked up again
+        Plan: The catalog may be used by several decode threads at once, so every access holds a lock and the
+              catalog is written back to disk after each change.
+        """
+        self.Path    = Path
+        self.Backend = Backend if Backend is not None else SAMWebBackend()
+        self.MaxAge  = MaxAge
+        self.Lock    = threading.Lock()
+        self.Entries = dict()
+        if os.path.exists(self.Path):
+            with open(self.Path, 'r') as File:
+                self.Entries = json.load(File)
+
+    def Save(self):
+        # The catalog is written to a temporary file which is then renamed into place, so an
+        # interrupted write never leaves a corrupt catalog behind.
+        Temporary = self.Path + '.tmp' + str(threading.get_ident())
+        with open(Temporary, 'w') as File:
+            json.dump(self.Entries, File, indent=2, sort_keys=True)
+        os.replace(Temporary, self.Path)
+
+    def Entry(self, Run):
+        # Returns the entry of the run, looking up its files if the entry is missing or has
+        # expired. The decoded file of an expired entry is kept.
+        with self.Lock:
+            Entry = self.Entries.get(str(Run))
+            if Entry is not None and time.time() - Entry['Time'] < self.MaxAge: return Entry
+            logging.debug('[ RunCatalog ]: Looking up files for run ' + str(Run))
+            Files = self.Backend.ListFiles(Run)
+            Decoded = Entry.get('Decoded') if Entry is not None else None
+            self.Entries[str(Run)] = {'Time': time.time(), 'Files': Files, 'Locations': dict(), 'Decoded': Decoded}
+            self.Save()
+            return self.Entries[str(Run)]
+
+    def Files(self, Run):
+        return self.Entry(Run)['Files']
+
+    def Paths(self, Run, Select='_1_'):
+        # Returns the full path of each file of the run containing Select in its name. By
+        # default this selects the files of DataLogger1, the only one sent to tape. Only the
+        # selected files are located, and their locations are kept with the entry.
+        Entry = self.Entry(Run)
+        Selected = [ Name for Name in Entry['Files'] if Select in Name ]
+        with self.Lock:
+            Missing = [ Name for Name in Selected if Name not in Entry['Locations'] ]
+            for Name in Missing: Entry['Locations'][Name] = self.Backend.LocateFile(Name)
+            if len(Missing) > 0: self.Save()
+        return [ Entry['Locations'][Name] + '/' + Name for Name in Selected ]
+
+    def Decoded(self, Run):
+        # Returns the decoded file of the run, or None if there is none or it no longer exists.
+        with self.Lock:
+            Decoded = self.Entries.get(str(Run), dict()).get('Decoded')
+        return Decoded if Decoded is not None and os.path.exists(Decoded) else None
+
+    def SetDecoded(self, Run, Path):
+        with self.Lock:
+            self.Entries.setdefault(str(Run), {'Time': 0, 'Files': [], 'Locations': dict()})['Decoded'] = Path
+            self.Save()
+
+def RemoveSupplemental(Pattern='Supplemental*.root'):
+    # The decoder tends to produce Supplemental files, which we should tidy up.
+    for Name in glob.glob(Pattern):
+        os.remove(Name)
+        logging.debug('[ RemoveSupplemental() ]: Removed supplemental file ' + Name)
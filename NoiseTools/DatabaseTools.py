@@ -1,27 +1,39 @@
 import numpy as np
 import sys
+import os
+import glob
+import time
+import hashlib
 import logging
 import pandas as pd
-sys.path.insert(0, '/icarus/app/users/mueller/NoiseStudies/workdir/hdbClient')
-from DataLoader3 import DataQuery
+from concurrent.futures import ThreadPoolExecutor
 
-def MapChannel(Channel):
+HDBCLIENT = '/icarus/app/users/mueller/NoiseStudies/workdir/hdbClient' # Location of DataLoader3.
+URL = 'https://dbdata0vm.fnal.gov:9443/QE/hw/app/SQ/query' # The web frontend for the db.
+DATABASE = 'icarus_hardware_dev'                           # Database name.
+DAQCHANNELS = 'daq_channels'                               # Table for DAQ channels.
+READOUTBOARDS = 'readout_boards'                           # Table for readout boards.
+FLANGES = 'flanges'                                        # Table for flanges.
+MAPVERSION = 1                                             # Version of the cached map format.
+
+def DataQuery(URL):
+    # The DataQuery class is specifically designed for Fermilab experiment hardware databases
+    # and acts as an interface between a hardware database and the user. It is only imported
+    # when a query is made, so this module can be used (e.g. with a cached map, or with a
+    # stand-in Client) where the hdbClient package is not installed.
+    if HDBCLIENT not in sys.path: sys.path.insert(0, HDBCLIENT)
+    from DataLoader3 import DataQuery as Query
+    return Query(URL)
+
+def MapChannel(Channel, URL=URL, Client=DataQuery):
     # Unfortunately there is a lot of gymnastics necessary to navigate the hardware
     # database tables. The information we need to create a full channel map is
     # spread across three separate tables.
-    
-    URL = 'https://dbdata0vm.fnal.gov:9443/QE/hw/app/SQ/query' # The web frontend for the db.
-    DATABASE = 'icarus_hardware_dev'                           # Database name.
-    DAQCHANNELS = 'daq_channels'                               # Table for DAQ channels.
-    READOUTBOARDS = 'readout_boards'                           # Table for readout boards.
-    FLANGES = 'flanges'                                        # Table for flanges.
 
-    # The DataQuery class is specifically designed for Fermilab experiment hardware databases
-    # and acts as an interface between a hardware database and the user. The DataQuery class
-    # requires the URL for the web frontend of the database. The following lines set this
-    # object up and then chain together a series of queries to map a DAQ channel to the host
-    # mini-crate.
-    Query = DataQuery(URL)
+    # The Client (DataQuery by default) requires the URL for the web frontend of the
+    # database. The following lines set it up and then chain together a series of queries
+    # to map a DAQ channel to the host mini-crate.
+    Query = Client(URL)
     BoardID, BoardSlot, ChannelOnBoard = Query.query(
         DATABASE,
         DAQCHANNELS,
@@ -45,35 +57,104 @@ def MapChannel(Channel):
     # number on the board (0-63) as a further offset.
     return MiniCrate, int(BoardSlot)*64 + int(ChannelOnBoard)
 
-def BuildMapDataFrame(ChannelList, Name='ChannelMap'):
+def FetchTable(Table, Columns, URL=URL, Database=DATABASE, Client=DataQuery):
+    # This function retrieves the requested columns of every row of a hardware database
+    # table with a single query (no 'where' clause) and returns them as a dataframe of
+    # strings, along with the raw text of the response for use as a fingerprint. Client
+    # builds the query object from the URL (DataQuery unless a stand-in is given).
+    Query = Client(URL)
+    Rows = [ Row for Row in Query.query(Database, Table, Columns) if Row.strip() != '' ]
+    logging.debug('[ FetchTable() ]: Fetched ' + str(len(Rows)) + ' rows from ' + Table + '.')
+    Frame = pd.DataFrame([ [ x.strip() for x in Row.split(',') ] for Row in Rows ],
+                         columns=[ x.strip() for x in Columns.split(',') ])
+    return Frame, '\n'.join(Rows)
+
+def BuildFullMap(URL=URL, Database=DATABASE, CacheDir='MapCache', MaxAge=86400, MaxWorkers=3, Client=DataQuery):
+    # Rather than chaining three queries for every one of the ~55,000 channels as in
+    # MapChannel(), this function fetches the three tables in bulk (concurrently, with at
+    # most MaxWorkers requests in flight) and joins them locally. The result is a dataframe
+    # mapping every DAQ channel in the database (fID) to its mini-crate (fCrate) and
+    # 'local' channel number (fChannel).
+
+    # The joined map is cached on disk in CacheDir. The cache file name contains a digest
+    # of the table contents, so a new map is only built when the tables have changed. If
+    # the newest cached map is younger than MaxAge seconds it is trusted without asking
+    # the database at all.
+    os.makedirs(CacheDir, exist_ok=True)
+    Cached = sorted(glob.glob(os.path.join(CacheDir, 'ChannelMap_v' + str(MAPVERSION) + '_*.csv')), key=os.path.getmtime)
+    if len(Cached) > 0 and time.time() - os.path.getmtime(Cached[-1]) < MaxAge:
+        logging.debug('[ BuildFullMap() ]: Using recent cached map ' + Cached[-1])
+        return pd.read_csv(Cached[-1])
+
+    Tables = [ (DAQCHANNELS, 'channel_id, readout_board_id, readout_board_slot, channel_number'),
+               (READOUTBOARDS, 'readout_board_id, flange_id'),
+               (FLANGES, 'flange_id, flange_pos_at_chimney') ]
+    with ThreadPoolExecutor(max_workers=MaxWorkers) as Executor:
+        Results = list(Executor.map(lambda x : FetchTable(x[0], x[1], URL, Database, Client), Tables))
+    (Channels, ChannelText), (Boards, BoardText), (Flanges, FlangeText) = Results
+
+    Digest = hashlib.sha1((ChannelText + BoardText + FlangeText).encode()).hexdigest()[0:16]
+    CacheFile = os.path.join(CacheDir, 'ChannelMap_v' + str(MAPVERSION) + '_' + Digest + '.csv')
+    if os.path.exists(CacheFile):
+        logging.debug('[ BuildFullMap() ]: Tables unchanged, using cached map ' + CacheFile)
+        os.utime(CacheFile)
+        return pd.read_csv(CacheFile)
+
+    # The 'local' channel number refers only to the position on the mini-crate (0-575).
+    # There are 64 wires connected to each board, so we take the slot number * 64 with the
+    # channel number on the board (0-63) as a further offset.
+    Map = Channels.merge(Boards, on='readout_board_id', how='left').merge(Flanges, on='flange_id', how='left')
+    Map = pd.DataFrame({'fID': Map.channel_id.astype(int),
+                        'fChannel': Map.readout_board_slot.astype(int)*64 + Map.channel_number.astype(int),
+                        'fCrate': Map.flange_pos_at_chimney})
+    Map.to_csv(CacheFile, index=False)
+    logging.debug('[ BuildFullMap() ]: Wrote new cached map ' + CacheFile)
+    return pd.read_csv(CacheFile)
+
+def BuildMapDataFrame(ChannelList, Name='ChannelMap', **Options):
     # Unfortunately it is far too slow to query the hardware database each time we need
     # to map a channel. It is much faster to create a map once and then dump the results
     # to a file for future lookups. This is accomplished through a Pandas dataframe,
-    # which keeps the information organized and easy to manipulate.
+    # which keeps the information organized and easy to manipulate. Any Options are
+    # passed on to BuildFullMap() (e.g. the URL of the database frontend).
     
     logging.debug('[ BuildMapDataFrame() ]: BuildMapDataFrame() called with Name = ' + Name)
     
-    fMap = {'fID': [], 'fChannel': [], 'fCrate': []} # Used for easy dataframe construction
-    
-    logging.debug('[ BuildMapDataFrame() ]: Beginning map construction.')
-    
-    # Now we loop through each channel in the list of channels. For each channel, we
-    # map it to a MiniCrate (e.g. formatted as 'WE05') and a 'local' (0-575) channel
-    # number. These are stored in the previously constructed dictionary with the fID
-    # column corresponding to DAQ channel number, fChannel to the 'local' channel
-    # number, and fCrate to the name of the mini-crate formatted as a string (e.g. 'WE05').
+    # The map of every channel in the database is built in bulk (or read from the cache),
+    # then reduced to the requested channels. The fID column corresponds to DAQ channel
+    # number, fChannel to the 'local' channel number, and fCrate to the name of the
+    # mini-crate formatted as a string (e.g. 'WE05'). The rows keep the order of
+    # ChannelList, which is also the order of the per-channel arrays in the analysis.
     print('Beginning map construction')
-    for channel in ChannelList:
-        MiniCrate, ChannelOnCrate = MapChannel(channel)
-        fMap['fID'].append(channel)
-        fMap['fChannel'].append(ChannelOnCrate)
-        fMap['fCrate'].append(MiniCrate)
+    # A channel appearing more than once in the map (e.g. a repeated channel_id or
+    # readout_board_id row in the tables) would add rows to the merge and misalign the map
+    # with the per-channel arrays, so only the first entry of each channel is kept.
+    FullMap = BuildFullMap(**Options)
+    Duplicated = FullMap.fID.duplicated().sum()
+    if Duplicated > 0: logging.warning('[ BuildMapDataFrame() ]: Dropping ' + str(Duplicated) + ' duplicate channels from the hardware database map.')
+    FullMap = FullMap.drop_duplicates('fID')
+    Dataframe = pd.DataFrame({'fID': np.asarray(ChannelList, dtype=int)}).merge(FullMap, on='fID', how='left')
+    assert len(Dataframe) == len(ChannelList)
+    Missing = Dataframe.fCrate.isna().sum()
+    if Missing > 0: logging.warning('[ BuildMapDataFrame() ]: ' + str(Missing) + ' channels not found in the hardware database.')
     logging.debug('[ BuildMapDataFrame() ]: Finished map construction.')
     print('Finished map construction')
 
-    # Now we construct a Pandas dataframe and dump it to a file in order to have access
-    # to the map much quicker later.
-    Dataframe = pd.DataFrame(fMap)
+    # Now we dump the dataframe to a file in order to have access to the map much quicker
+    # later.
     Dataframe.to_csv(Name+'.csv', index=False)
     logging.debug('[ BuildMapDataFrame() ]: Finished writing map. Exiting BuildMapDataFrame().')
 
+def AlignMap(Map, ChannelList):
+    # The channel map is used with the per-channel arrays of the analysis row by row (e.g.
+    # by CrateIndex to group the waveforms by crate and readout board), so its rows must
+    # follow ChannelList. A map written for another run, or in another order, is reordered
+    # to one row per channel of ChannelList. Channels missing from the map are kept with
+    # no crate, and channels of the map not in ChannelList are dropped.
+    ChannelList = np.asarray(ChannelList, dtype=int)
+    if len(Map) == len(ChannelList) and np.array_equal(Map.fID.to_numpy(), ChannelList): return Map.reset_index(drop=True)
+    logging.warning('[ AlignMap() ]: The channel map does not follow the channel list. Reordering it.')
+    Aligned = pd.DataFrame({'fID': ChannelList}).merge(Map.drop_duplicates('fID'), on='fID', how='left')
+    Missing = Aligned.fCrate.isna().sum()
+    if Missing > 0: logging.warning('[ AlignMap() ]: ' + str(Missing) + ' channels are missing from the channel map.')
+    return Aligned
@@ -0,0 +1,117 @@
+import re
+from TraceTools import Span
+
+# The full list of mini-crates in the TPC, each of which has a tagged location in the SVG
+# base file of the heatmap.
+MiniCrateList = ['EE01B', 'EE01M', 'EE01T', 'EE02', 'EE03', 'EE04',
+                 'EE05', 'EE06', 'EE07', 'EE08', 'EE09', 'EE10',
+                 'EE11', 'EE12', 'EE13', 'EE14', 'EE15', 'EE16',
+                 'EE17', 'EE18', 'EE19', 'EE20B', 'EE20M', 'EE20T',
+                 'EW01B', 'EW01M', 'EW01T', 'EW02', 'EW03', 'EW04',
+                 'EW05', 'EW06', 'EW07', 'EW08', 'EW09', 'EW10',
+                 'EW11', 'EW12', 'EW13', 'EW14', 'EW15', 'EW16',
+                 'EW17', 'EW18', 'EW19', 'EW20B', 'EW20M', 'EW20T',
+                 'WE01B', 'WE01M', 'WE01T', 'WE02', 'WE03', 'WE04',
+                 'WE05', 'WE06', 'WE07', 'WE08', 'WE09', 'WE10',
+                 'WE11', 'WE12', 'WE13', 'WE14', 'WE15', 'WE16',
+                 'WE17', 'WE18', 'WE19', 'WE20B', 'WE20M', 'WE20T',
+                 'WW01B', 'WW01M', 'WW01T', 'WW02', 'WW03', 'WW04',
+                 'WW05', 'WW06', 'WW07', 'WW08', 'WW09', 'WW10',
+                 'WW11', 'WW12', 'WW13', 'WW14', 'WW15', 'WW16',
+                 'WW17', 'WW18', 'WW19', 'WW20B', 'WW20M', 'WW20T']
+
+class SVGTemplate:
+    """
+    SVGTemplate: An SVG base file with '$tag$' placeholders, parsed once into a list of literal segments and
+    placeholders. Filling the template is then a single pass over the segments rather than a search and replace
+    over the whole document for every tag.
+    """
+    Cache = dict()
+
+    def __init__(self, SVGBase):
+        """
+        args: SVGBase is the name of the SVG base file (without the '.svg' extension)
+        """
+        with open(SVGBase+'.svg', 'r') as SVGFile:
+            # Splitting on a capturing group leaves the placeholders at the odd indices.
+            self.Segments = re.split(r'(\$[A-Za-z0-9_]+\$)', SVGFile.read())
+
+    @classmethod
+    def Load(cls, SVGBase):
+        # Each base file is only read and parsed once per process.
+        if SVGBase not in cls.Cache: cls.Cache[SVGBase] = cls(SVGBase)
+        return cls.Cache[SVGBase]
+
+    def Fill(self, Changes):
+        # Placeholders without an entry in Changes are left untouched.
+        return ''.join([ Changes.get(x, x) if n % 2 == 1 else x for n, x in enumerate(self.Segments) ])
+
+def PlotPowerAsHeatmap(PowerFrame, Tag, Gradient, SVGBase, BarLabel, ZMin=0, ZMax=10000, EmptyColor='255,255,255', OutFile=None):
+    # This function creates a heatmap style plot of the peak powers for each mini-crate. A          
+    # SVG graphic of the geographic layout of the TPC mini-crates is used as the base for           
+    # this plot. The base contains some helpful 'tags' that allow me to substitute the              
+    # proper values for the color of the mini-crate, the gradient of the legend, and any            
+    # labels. It's a bit gimmicky, but a geographic layout is what we're after here.                
+
+    # First we focus our attention on the legend. We use matplotlib to access predefined            
+    # gradients, which saves a lot of trouble in making our own. Then we create an empty            
+    # dictionary to be used as a map for tags and the value they need to be replaced by.            
+    # The first thing we add to the dictionary are the colors that are used as points for           
+    # interpolation to a full gradient. Simultaneously we also set each of the labels for           
+    # the ticks in the legend.                                                                      
+    # matplotlib is only imported here, as rendering the heatmaps is the only thing which
+    # needs it (and not pyplot at all).
+    import matplotlib
+    import matplotlib.colors as colors
+    nTicks = 6
+    CMap = matplotlib.colormaps[Gradient]
+    LegendTicks = [ x * (ZMax-ZMin)/5 for x in range(nTicks) ]
+    Changes = dict()
+    for tick in range(nTicks):
+        Changes['$col' + str(tick+1) + '$'] = colors.to_hex(CMap(0.2*tick))
+        Changes['$val' + str(tick+1) + '$'] = str(LegendTicks[tick])
+
+    # Now we configure the changes that need to be made to the color of each mini-crate. The
+    # location where the color is set for each mini-crate in the SVG base file is tagged with
+    # the mini-crate name (e.g. $WE05$). Therefore we need only swap this tag with the color
+    # in rgb notation (e.g. rgb(0,0,0)). Of course it may be the case that not all mini-
+    # crates are represented in the dataframe, so we need to set the remaining mini-crates
+    # as well to some neutral color. To simplify this a little, we can set the default first
+    # then override with the proper color if applicable. The colors of all mini-crates in the
+    # dataframe are looked up at once after normalizing to the requested ZMin and ZMax.
+    for MiniCrate in MiniCrateList:
+        Changes['$' + MiniCrate + '$'] = 'rgb(' + EmptyColor + ')'
+    RGB = 255*CMap( ( PowerFrame[Tag].to_numpy(dtype=float) - ZMin ) / (ZMax - ZMin) )[:,0:3]
+    for MiniCrate, Color in zip(PowerFrame.fCrate, RGB):
+        Changes['$' + MiniCrate + '$'] = 'rgb({}, {}, {})'.format(*[ float(x) for x in Color ])
+
+    # We also should change the label on the colorbar to the appropriate setting.
+    Changes['$bar_label$'] = BarLabel
+
+    # Now we have all of the changes defined that we need and can proceed with implementing
+    # them. The template is parsed once and filled in a single pass, then the string is
+    # written to the requested file.
+    if OutFile is None: OutFile = 'ModSVG_' + Tag + '.svg'
+    with open(OutFile, 'w') as SVGFile:
+        SVGFile.write(SVGTemplate.Load(SVGBase).Fill(Changes))
+
+def PlotHeatmaps(PowerFrame, HeatmapCfg, Path='', PerRun=False):
+    # This function renders the heatmap of every column requested in the SVGHeatmap section
+    # of the configuration (HeatmapCfg), with the matching color bar label and z-range. The
+    # files are written to Path as ModSVG_<Tag>.svg. If PerRun is set and the dataframe has
+    # a fRun column, a heatmap is also rendered for each run as ModSVG_<Tag>_Run<N>.svg.
+    Frames = [ ('', PowerFrame) ]
+    if PerRun and 'fRun' in PowerFrame.columns:
+        Frames += [ ('_Run' + str(Run), Frame) for Run, Frame in PowerFrame.groupby('fRun') ]
+    with Span('Heatmap', Heatmaps=len(Frames)*len(HeatmapCfg['Columns'])):
+        for Suffix, Frame in Frames:
+            for Tag, BarLabel, ZMin, ZMax in zip(HeatmapCfg['Columns'], HeatmapCfg['BarLabel'], HeatmapCfg['ZMin'], HeatmapCfg['ZMax']):
+                PlotPowerAsHeatmap(Frame,
+                                   Tag,
+                                   HeatmapCfg['Gradient'],
+                                   HeatmapCfg['SVGBase'],
+                                   BarLabel,
+                                   ZMin=ZMin,
+                                   ZMax=ZMax,
+                                   EmptyColor=HeatmapCfg['EmptyColor'],
+                                   OutFile=Path + 'ModSVG_' + Tag + Suffix + '.svg')
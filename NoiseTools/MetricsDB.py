@@ -0,0 +1,109 @@
+import numpy as np
+import pandas as pd
+import sqlite3
+import logging
+from TraceTools import Span
+
+# The columns of the two metrics tables and their SQL types. The per-channel table holds
+# one row per run and DAQ channel, the per-crate table one row per run and mini-crate.
+CHANNELCOLUMNS = [ ('fRun', 'INTEGER'), ('fID', 'INTEGER'), ('fCrate', 'TEXT'), ('fChannel', 'INTEGER'),
+                   ('fRMS', 'REAL'), ('fUnRMS', 'REAL'), ('fFreq', 'REAL'), ('fPow', 'REAL'),
+                   ('fPowSep', 'REAL'), ('fPowBack', 'REAL'), ('fRatio', 'REAL') ]
+CRATECOLUMNS = [ ('fRun', 'INTEGER'), ('fCrate', 'TEXT'), ('fFreq', 'REAL'), ('fPow', 'REAL'),
+                 ('fPowSep', 'REAL'), ('fPowBack', 'REAL'), ('fRatio', 'REAL'),
+                 ('fCorrMean', 'REAL'), ('fCorrBoard', 'REAL'), ('fCoherentFrac', 'REAL') ]
+TABLES = {'ChannelMetrics': (CHANNELCOLUMNS, ('fRun', 'fID')),
+          'CrateMetrics': (CRATECOLUMNS, ('fRun', 'fCrate'))}
+
+class MetricsDB:
+    """
+    MetricsDB: A local SQLite database indexing the per-channel and per-crate noise metrics of every analyzed
+    run, so trends across many runs can be queried without reading back the metrics of each run.
+    """
+    def __init__(self, Path):
+        """
+        args: Path is the SQLite file holding the database (created if it does not exist)
+        Plan: The tables are keyed on (run, channel) and (run, crate) and carry additional indices on the
+              crate and channel, which are the columns the history queries select on. Columns added to the tables
+              since a database was created are added to it (as NULL for the runs already stored).
+        """
+        self.Path = Path
+        self.Connection = sqlite3.connect(Path)
+        for Table, (Columns, Key) in TABLES.items():
+            Definition = ', '.join([ Name + ' ' + Type for Name, Type in Columns ])
+            self.Connection.execute('CREATE TABLE IF NOT EXISTS ' + Table + ' (' + Definition + ', PRIMARY KEY (' + ', '.join(Key) + '))')
+            Existing = [ Row[1] for Row in self.Connection.execute('PRAGMA table_info(' + Table + ')') ]
+            for Name, Type in Columns:
+                if Name not in Existing: self.Connection.execute('ALTER TABLE ' + Table + ' ADD COLUMN ' + Name + ' ' + Type)
+            self.Connection.execute('CREATE INDEX IF NOT EXISTS ' + Table + '_fCrate ON ' + Table + ' (fCrate, fRun)')
+        self.Connection.execute('CREATE INDEX IF NOT EXISTS ChannelMetrics_fID ON ChannelMetrics (fID, fRun)')
+        self.Connection.commit()
+
+    def Insert(self, Table, Frame):
+        # Inserts the rows of the dataframe into the requested table. Columns of the table
+        # missing from the dataframe are stored as NULL, other columns of the dataframe are
+        # ignored. All rows already stored for the runs of the dataframe are removed in the
+        # same transaction, so a re-analyzed run keeps no channels or crates it no longer
+        # has (e.g. after a crate was masked).
+        Columns = [ Name for Name, Type in TABLES[Table][0] ]
+        Frame = Frame.reindex(columns=Columns)
+        Runs = [ (int(Run),) for Run in Frame.fRun.dropna().unique() ]
+        Frame = Frame.astype(object).where(Frame.notna(), None)
+        Rows = [ tuple(x.item() if isinstance(x, np.generic) else x for x in Row) for Row in Frame.itertuples(index=False) ]
+        with Span('Write', Store=Table, Rows=len(Rows)), self.Connection:
+            self.Connection.executemany('DELETE FROM ' + Table + ' WHERE fRun = ?', Runs)
+            self.Connection.executemany('INSERT OR REPLACE INTO ' + Table + ' (' + ', '.join(Columns) + ') VALUES (' + ', '.join(['?']*len(Columns)) + ')', Rows)
+        logging.debug('[ MetricsDB ]: Inserted ' + str(len(Rows)) + ' rows into ' + Table)
+
+    def Query(self, SQL, Parameters=()):
+        # Runs an arbitrary query against the database and returns the result as a dataframe.
+        return pd.read_sql_query(SQL, self.Connection, params=Parameters)
+
+    def Runs(self):
+        # Returns the sorted list of runs stored in the database.
+        return self.Query('SELECT DISTINCT fRun FROM CrateMetrics ORDER BY fRun').fRun.tolist()
+
+    def ChannelHistory(self, Channel, Column='fRMS', LastRuns=200):
+        # Returns the requested metric of a DAQ channel (fID) for the last LastRuns runs in
+        # which the channel was analyzed, ordered by run.
+        self.Check('ChannelMetrics', Column)
+        return self.Query('SELECT * FROM (SELECT fRun, ' + Column + ' FROM ChannelMetrics WHERE fID = ? ORDER BY fRun DESC LIMIT ?) ORDER BY fRun',
+                          (int(Channel), int(LastRuns)))
+
+    def CrateHistory(self, MiniCrate, Column='fPow', LastRuns=200):
+        # Returns the requested metric of a mini-crate for the last LastRuns runs in which the
+        # mini-crate was analyzed, ordered by run.
+        self.Check('CrateMetrics', Column)
+        return self.Query('SELECT * FROM (SELECT fRun, ' + Column + ' FROM CrateMetrics WHERE fCrate = ? ORDER BY fRun DESC LIMIT ?) ORDER BY fRun',
+                          (str(MiniCrate), int(LastRuns)))
+
+    def CratesAbove(self, Threshold, Column='fRatio', Runs=None):
+        # Returns the run, mini-crate, and value of every mini-crate whose metric exceeded the
+        # threshold, optionally only for the requested runs.
+        self.Check('CrateMetrics', Column)
+        SQL = 'SELECT fRun, fCrate, ' + Column + ' FROM CrateMetrics WHERE ' + Column + ' > ?'
+        Parameters = [ float(Threshold) ]
+        if Runs is not None:
+            SQL += ' AND fRun IN (' + ', '.join(['?']*len(Runs)) + ')'
+            Parameters += [ int(x) for x in Runs ]
+        return self.Query(SQL + ' ORDER BY fRun, fCrate', Parameters)
+
+    def ChannelsAbove(self, Threshold, Column='fRMS', Run=None):
+        # Returns the run, DAQ channel, mini-crate, and value of every channel whose metric
+        # exceeded the threshold, optionally only for a single run.
+        self.Check('ChannelMetrics', Column)
+        SQL = 'SELECT fRun, fID, fCrate, ' + Column + ' FROM ChannelMetrics WHERE ' + Column + ' > ?'
+        Parameters = [ float(Threshold) ]
+        if Run is not None:
+            SQL += ' AND fRun = ?'
+            Parameters.append(int(Run))
+        return self.Query(SQL + ' ORDER BY fRun, fID', Parameters)
+
+    def Check(self, Table, Column):
+        # Column names can't be passed as query parameters, so they are checked against the
+        # columns of the table before being placed into a query.
+        if Column not in [ Name for Name, Type in TABLES[Table][0] ]:
+            raise ValueError('Unknown column ' + str(Column) + ' for table ' + Table)
+
+    def Close(self):
+        self.Connection.close()
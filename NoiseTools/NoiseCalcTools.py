@@ -1,87 +1,529 @@
 import numpy as np
-import scipy.signal as signal
 import pandas as pd
 import logging
-from numba import njit, jit
+from numba import njit, prange
+import multiprocessing
 from RawDigits import RawDigit
+from TraceTools import Span
+from SpectraTools import SNIPReach
+
+# The heavier modules (scipy.signal, scipy.fft, scipy.sparse, uproot) are imported by the
+# functions which use them rather than here, so that importing the module (e.g. only for
+# the peak finding) stays fast. The numba kernels are cached on disk (cache=True), so they
+# are only compiled the first time they are used, not in every process.
+
+@njit(parallel=True, cache=True)
+def PedestalKernel(Waveforms):
+    # This function calculates the pedestal (median), the pedestal-subtracted sum of squares
+    # and the RMS of each waveform (row) of an integer array (nChannels,nTicks). Since the
+    # ADC values are small integers, the exact median can be found in linear time from a
+    # counting histogram of each waveform instead of by sorting. The sum of squares then
+    # also only needs one pass over the (few) occupied histogram bins. The channels are
+    # independent of each other, so numba spreads them over all cores.
+    nChannels, nTicks = Waveforms.shape
+    Pedestals = np.empty(nChannels)
+    SumSq = np.empty(nChannels)
+    RMS = np.empty(nChannels)
+    for c in prange(nChannels):
+        Low = np.int64(Waveforms[c,0])
+        High = Low
+        for t in range(nTicks):
+            Low = min(Low, np.int64(Waveforms[c,t]))
+            High = max(High, np.int64(Waveforms[c,t]))
+        Counts = np.zeros(High-Low+1, dtype=np.int64)
+        for t in range(nTicks):
+            Counts[np.int64(Waveforms[c,t])-Low] += 1
+
+        # The median is the mean of the order statistics (nTicks-1)//2 and nTicks//2 (which
+        # are the same for an odd number of ticks), just as for np.median().
+        Cumulative = 0
+        First = -1
+        Second = -1
+        for b in range(len(Counts)):
+            Cumulative += Counts[b]
+            if First < 0 and Cumulative > (nTicks-1)//2: First = b
+            if Cumulative > nTicks//2:
+                Second = b
+                break
+        Pedestals[c] = Low + (First + Second)/2.0
+
+        Sum = 0.0
+        for b in range(len(Counts)):
+            if Counts[b] > 0:
+                Residual = Low + b - Pedestals[c]
+                Sum += Counts[b] * Residual * Residual
+        SumSq[c] = Sum
+        RMS[c] = np.sqrt(Sum / nTicks)
+    return Pedestals, SumSq, RMS
+
+def PedestalRMS(Waveforms):
+    # This function returns the pedestal and the pedestal-subtracted RMS of each waveform.
+    # Integer waveforms (the raw digits) use the histogram kernel, anything else falls back
+    # to np.median().
+    if np.issubdtype(Waveforms.dtype, np.integer):
+        Pedestals, SumSq, RMS = PedestalKernel(Waveforms)
+    else:
+        Pedestals = np.median(Waveforms, axis=-1)
+        WaveLessPeds = Waveforms - Pedestals.reshape((Pedestals.shape)+(1,))
+        RMS = np.sqrt(np.mean(np.square(WaveLessPeds),axis=-1))
+    return Pedestals, RMS
+
+def BandBins(Frequency, Band=None, Padding=0, Reach=None):
+    # This function returns the slice of the frequency bins (MHz) which are needed for a
+    # band (fLow, fHigh) in kHz: every bin in the band widened by Padding kHz on each side,
+    # so the SNIP background in the band can still be found. The padding must cover the
+    # Reach (in bins) of the SNIP background (see SNIPReach(), by default that of the 20
+    # iterations used in the analysis), otherwise the background at the edges of the band
+    # would differ from that of the full spectrum. A smaller Padding is widened to the
+    # Reach with a warning. Without a Band all bins are kept.
+    if Band is None: return slice(0, len(Frequency))
+    if Reach is None: Reach = SNIPReach()
+    Width = 1000*(Frequency[1] - Frequency[0])
+    nPadding = int(np.ceil(round(Padding / Width, 6)))
+    if nPadding < Reach:
+        logging.warning('[ BandBins() ]: A padding of ' + str(Padding) + ' kHz is only ' + str(nPadding) + ' bins, but the SNIP background reaches '
+                        + str(Reach) + ' bins (' + str(round(Reach*Width, 1)) + ' kHz). Using ' + str(Reach) + ' bins instead.')
+        nPadding = Reach
+    Bins = np.flatnonzero( (1000*Frequency >= Band[0]) & (1000*Frequency <= Band[1]) )
+    return slice(max(Bins[0] - nPadding, 0), min(Bins[-1] + 1 + nPadding, len(Frequency)))
+
+def BinOffset(Frequency):
+    # This function returns the index in the full spectrum of the first of the (evenly
+    # spaced) frequency bins, which is 0 unless the spectrum is band-limited.
+    if len(Frequency) < 2: return 0
+    return int(round(Frequency[0] / (Frequency[1] - Frequency[0])))
 
 def RMSCalcOne(Waveforms):
-    Pedestals = np.median(Waveforms, axis=-1)
-    WaveLessPeds = Waveforms - Pedestals.reshape((Pedestals.shape)+(1,))
-    RMS = np.sqrt(np.mean(np.square(WaveLessPeds),axis=-1))
+    Pedestals, RMS = PedestalRMS(Waveforms)
     return RMS
 
-@jit(parallel=True)
-def RMSCalc(RawDigits, NumEvents=50):
-    # This function calculates the RMS for each channel and returns an average over the
-    # number of events. The RawDigits argument is an object which serves as an interface 
-    # to retrieving the raw digits from the input ROOT file.
-    
+class NoiseAccumulator:
+    """
+    NoiseAccumulator: Streaming accumulator for the per-channel noise metrics of a single producer. Each event is
+    handed to Update() exactly once; the pedestal is found once and then shared by the RMS and the power spectrum,
+    which are summed together. Result() returns the averages over the events seen so far. If a Band is given, only
+    the bins of the band (and its padding) are kept, which shrinks the accumulated spectra and every later stage.
+    """
+    def __init__(self, nChannels, nTicks, IsRaw=True, DoRMS=True, DoSpectrum=True, SampleRate=1/0.4, Engine='periodogram', BlockSize=1024,
+                 Band=None, Padding=0, Reach=None):
+        """
+        args: nChannels and nTicks give the shape of the waveforms of each event
+              IsRaw is True if the waveforms still carry a pedestal (not coherent noise subtracted)
+              DoRMS and DoSpectrum switch the two metrics on or off
+              SampleRate is the digitization frequency in MHz (0.4 us per tick)
+              Engine selects the spectrum calculation: 'periodogram' (scipy, float64) or 'rfft' (float32 blocks)
+              BlockSize is the number of channels transformed at once by the 'rfft' engine
+              Band is the (fLow, fHigh) in kHz the spectrum is limited to, or None for the full spectrum
+              Padding is the width in kHz added to either side of the Band
+              Reach is the least number of bins added to either side (see BandBins(), None for 20 SNIP iterations)
+        Plan: The whole waveform is still transformed and only the bins of the band are kept. Computing just those
+              bins (Goertzel, a direct DFT) costs nTicks operations per bin and is slower than the full FFT for
+              anything but a handful of bins, so the saving is in the memory of the accumulated spectra and in the
+              crate means, SNIP and peak finding which follow.
+        """
+        self.IsRaw      = IsRaw
+        self.DoRMS      = DoRMS
+        self.DoSpectrum = DoSpectrum
+        self.SampleRate = SampleRate
+        self.Engine     = Engine
+        self.N          = 0
+        self.RMS        = np.zeros(nChannels) if DoRMS else None
+        self.Pedestals  = np.empty(nChannels) if DoRMS or IsRaw else None
+        self.Frequency  = np.fft.rfftfreq(nTicks, 1/SampleRate)
+        self.Bins       = BandBins(self.Frequency, Band, Padding, Reach)
+        self.Frequency  = self.Frequency[self.Bins]
+        nFreq           = len(self.Frequency)
+        if Engine == 'rfft':
+            # The work buffers are allocated once and reused for every block of every event.
+            # Only the accumulated spectrum is of the full (nChannels,nFreq) size.
+            self.BlockSize = min(BlockSize, nChannels)
+            self.Buffer    = np.empty((self.BlockSize,nTicks), dtype=np.float32)
+            self.Power     = np.empty((self.BlockSize,nTicks//2+1), dtype=np.float32)
+            self.Spectrum  = np.zeros((nChannels,nFreq), dtype=np.float32) if DoSpectrum else None
+        elif Engine == 'periodogram':
+            self.Spectrum  = np.zeros((nChannels,nFreq)) if DoSpectrum else None
+        else:
+            raise ValueError('Unknown spectrum engine: ' + str(Engine))
+
+    def Update(self, Waveforms):
+        if self.Engine == 'rfft':
+            self.UpdateBlocks(Waveforms)
+            self.N += 1
+            return
+
+        # The pedestal is the median of each waveform. It is needed for the RMS and, for
+        # raw waveforms, for the spectrum. This would be redundant for the coherent
+        # subtracted waveforms, which are passed to the periodogram as they are. The
+        # pedestals of the latest event are kept (self.Pedestals) so the coherent noise
+        # removal and the correlations can reuse them.
+        with Span('Pedestal', Channels=len(Waveforms)):
+            Pedestals, RMS = PedestalRMS(Waveforms)
+        self.Pedestals = Pedestals
+        if self.DoRMS:
+            self.RMS += RMS
+        if self.DoSpectrum:
+            with Span('FFT', Channels=len(Waveforms)):
+                import scipy.signal as signal
+                if self.IsRaw:
+                    WaveLessPeds = Waveforms - Pedestals.reshape((Pedestals.shape)+(1,))
+                    Frequency, tmpSpectrum = signal.periodogram(WaveLessPeds, self.SampleRate, axis=1)
+                else: Frequency, tmpSpectrum = signal.periodogram(Waveforms, self.SampleRate, axis=1)
+                self.Spectrum += tmpSpectrum[:,self.Bins]
+        self.N += 1
+
+    def UpdateBlocks(self, Waveforms):
+        # The 'rfft' engine works through the channels BlockSize at a time using the float32
+        # work buffers. The scaling reproduces scipy.signal.periodogram with its defaults: the
+        # mean of each waveform is removed ('constant' detrend, which also makes the pedestal
+        # irrelevant for the spectrum), a boxcar window is used, and the one-sided density is
+        # |X|^2 / (fs * nTicks) with every bin but DC (and Nyquist for even nTicks) doubled.
+    # The float32 transform agrees with the float64 periodogram to about 1e-4 of each bin
+    # (1e-6 of the largest bin of the channel), see tests/test_NoiseCalcTools.py.
+        # The pedestals are found for the RMS and, for raw waveforms, kept for reuse even if
+        # the RMS is not needed.
+        import scipy.fft as fft
+        nChannels, nTicks = Waveforms.shape
+        Scale = np.float32(1.0 / (self.SampleRate * nTicks))
+        Last = -1 if nTicks % 2 == 0 else None
+        for Start in range(0, nChannels, self.BlockSize):
+            Stop = min(Start + self.BlockSize, nChannels)
+            if self.Pedestals is not None:
+                with Span('Pedestal', Channels=Stop-Start):
+                    self.Pedestals[Start:Stop], RMS = PedestalRMS(Waveforms[Start:Stop])
+                if self.DoRMS: self.RMS[Start:Stop] += RMS
+            if self.DoSpectrum:
+                with Span('FFT', Channels=Stop-Start):
+                    Buffer = self.Buffer[:Stop-Start]
+                    Buffer[:] = Waveforms[Start:Stop]
+                    Buffer -= np.mean(Buffer, axis=-1, keepdims=True)
+                    Power = self.Power[:Stop-Start]
+                    np.abs(fft.rfft(Buffer, axis=-1), out=Power)
+                    np.square(Power, out=Power)
+                    Power *= Scale
+                    Power[:,1:Last] *= 2
+                    # The DC bin of a waveform without its mean is zero. In float32 the mean
+                    # isn't removed exactly (e.g. for an odd nTicks), so it is set instead.
+                    Power[:,0] = 0
+                    self.Spectrum[Start:Stop] += Power[:,self.Bins]
+
+    def Merge(self, Other):
+        # Partial sums from another accumulator over a disjoint set of events can simply
+        # be added to our own.
+        if self.DoRMS: self.RMS += Other.RMS
+        if self.DoSpectrum: self.Spectrum += Other.Spectrum
+        self.N += Other.N
+
+    def Reset(self):
+        # Clears the sums so the accumulator (and its work buffers) can be reused.
+        if self.DoRMS: self.RMS[:] = 0
+        if self.DoSpectrum: self.Spectrum[:] = 0
+        self.N = 0
+
+    def Result(self):
+        # The RMS (nChannels) and power spectrum (nChannels,nFreq) averaged over the number
+        # of events which have been accumulated.
+        RMS = self.RMS / self.N if self.DoRMS else None
+        Spectrum = self.Spectrum / self.N if self.DoSpectrum else None
+        return RMS, self.Frequency, Spectrum
+
+class ConvergenceMonitor:
+    """
+    ConvergenceMonitor: Decides when enough events have been averaged. After each event it tracks the running mean
+    and standard error (with Welford's method) of the RMS of each channel and of the band power (fLow to fHigh) of
+    each mini-crate. Averaging stops once every relative standard error is below Tolerance, but not before
+    MinEvents or after MaxEvents events. Without a Tolerance it only counts the events.
+    """
+    def __init__(self, Matrix=None, fLow=1, fHigh=800, Tolerance=None, MinEvents=10, MaxEvents=50):
+        """
+        args: Matrix is the (nCrates,nChannels) crate averaging matrix (see CrateIndex)
+              fLow and fHigh give the band in kHz whose power is tracked
+              Tolerance is the relative standard error at which the averages are considered converged
+              MinEvents and MaxEvents bound the number of events averaged
+        """
+        self.Matrix    = Matrix
+        self.fLow      = fLow
+        self.fHigh     = fHigh
+        self.Tolerance = Tolerance
+        self.MinEvents = MinEvents
+        self.MaxEvents = MaxEvents
+        self.N         = 0
+        self.Errors    = (np.nan, np.nan)
+
+    def Update(self, Accumulator):
+        # Called after each event with the accumulator of the raw waveforms. The metrics of
+        # the latest event are the change in the accumulated sums since the previous call,
+        # so only the sums of the previous event need to be kept. Returns True once converged.
+        self.N = Accumulator.N
+        if self.Tolerance is None: return False
+        if self.N == 1:
+            self.Band = (1000*Accumulator.Frequency >= self.fLow) & (1000*Accumulator.Frequency <= self.fHigh)
+            self.LastRMS, self.LastBand = np.zeros(len(Accumulator.RMS)), np.zeros(len(Accumulator.RMS))
+            self.Means = [ np.zeros(len(Accumulator.RMS)), np.zeros(self.Matrix.shape[0]) ]
+            self.M2s   = [ np.zeros(len(Accumulator.RMS)), np.zeros(self.Matrix.shape[0]) ]
+        Band = Accumulator.Spectrum[:,self.Band].sum(axis=1, dtype=np.float64)
+        Values = [ Accumulator.RMS - self.LastRMS, self.Matrix @ (Band - self.LastBand) ]
+        self.LastRMS, self.LastBand = Accumulator.RMS.copy(), Band
+        for Value, Mean, M2 in zip(Values, self.Means, self.M2s):
+            Delta = Value - Mean
+            Mean += Delta / self.N
+            M2 += Delta * (Value - Mean)
+        if self.N > 1:
+            self.Errors = tuple( self.RelativeError(Mean, M2) for Mean, M2 in zip(self.Means, self.M2s) )
+        return self.Converged()
+
+    def RelativeError(self, Mean, M2):
+        # The largest standard error of the mean relative to the mean. Entries with a mean
+        # of zero (e.g. dead channels) are ignored.
+        Error = np.sqrt(M2 / (self.N - 1) / self.N)
+        Valid = Mean > 0
+        return np.max(Error[Valid] / Mean[Valid]) if np.any(Valid) else 0.0
+
+    def Converged(self):
+        if self.N >= self.MaxEvents: return True
+        return self.Tolerance is not None and self.N >= max(self.MinEvents, 2) and max(self.Errors) < self.Tolerance
+
+class CorrelationAccumulator:
+    """
+    CorrelationAccumulator: Streaming accumulator of the channel-to-channel covariance within each mini-crate. For
+    every event the pedestal-subtracted waveforms of each crate (nCrateChannels,nTicks) are multiplied with their own
+    transpose as a single float32 matrix product, and the products and per-channel sums are added up over events.
+    Result() returns the correlation matrix of each crate and Summary() the per-crate metrics derived from them.
+    """
+    def __init__(self, Crates):
+        """
+        args: Crates is the CrateIndex of the channel map, whose order (by crate, then 'local' channel number) the
+              rows and columns of the matrices follow
+        Plan: The sums are only allocated with the first event, so an empty accumulator is small enough to be
+              handed to the worker processes of NoiseCalc() and merged back afterwards.
+        """
+        self.Crates       = Crates.Crates
+        self.Order        = Crates.Order
+        self.Offsets      = Crates.Offsets
+        self.BoardOffsets = Crates.BoardOffsets
+        self.N            = 0
+        self.Ticks        = 0
+        self.Products     = None
+        self.Sums         = None
+
+    def Update(self, Waveforms, Pedestals=None):
+        # The pedestal is removed before the products are formed so the float32 products
+        # don't lose precision to it. Numpy recognizes X @ X.T and only computes one half of
+        # the symmetric product (BLAS syrk), which is accumulated in float64. The pedestals
+        # are found here unless they are given (e.g. by the NoiseAccumulator of the event).
+        if Pedestals is None: Pedestals, RMS = PedestalRMS(Waveforms)
+        if self.Products is None:
+            self.Products = [ np.zeros((Stop-Start,Stop-Start)) for Start, Stop in zip(self.Offsets[:-1], self.Offsets[1:]) ]
+            self.Sums     = [ np.zeros(Stop-Start) for Start, Stop in zip(self.Offsets[:-1], self.Offsets[1:]) ]
+        with Span('Correlation', Crates=len(self.Crates)):
+            for n in range(len(self.Crates)):
+                Channels = self.Order[self.Offsets[n]:self.Offsets[n+1]]
+                Block = Waveforms[Channels].astype(np.float32)
+                Block -= Pedestals[Channels].astype(np.float32).reshape((len(Channels),1))
+                self.Products[n] += Block @ Block.T
+                self.Sums[n] += Block.sum(axis=1, dtype=np.float64)
+        self.Ticks += Waveforms.shape[1]
+        self.N += 1
+
+    def Merge(self, Other):
+        # Partial sums from another accumulator over a disjoint set of events.
+        if Other.Products is None: return
+        if self.Products is None:
+            self.Products, self.Sums = [ x.copy() for x in Other.Products ], [ x.copy() for x in Other.Sums ]
+        else:
+            for Mine, Theirs in zip(self.Products + self.Sums, Other.Products + Other.Sums): Mine += Theirs
+        self.Ticks += Other.Ticks
+        self.N += Other.N
+
+    def Covariance(self, n):
+        # The covariance matrix of the channels of crate n over all ticks of all events.
+        Mean = self.Sums[n] / self.Ticks
+        return self.Products[n] / self.Ticks - np.outer(Mean, Mean)
+
+    def Result(self):
+        # The correlation matrix of each crate (in the order of Crates), with NaN for the
+        # rows and columns of channels without any noise (e.g. dead channels).
+        Matrices = list()
+        for n in range(len(self.Crates)):
+            Covariance = self.Covariance(n)
+            Std = np.sqrt(np.clip(np.diag(Covariance), 0, None))
+            with np.errstate(divide='ignore', invalid='ignore'):
+                Matrices.append(Covariance / np.outer(Std, Std))
+        return Matrices
+
+    def Bytes(self):
+        # The memory taken by the sums once they are allocated.
+        Counts = np.diff(self.Offsets).astype(np.int64)
+        return int(np.sum(Counts * Counts + Counts)) * 8
+
+    def Summary(self):
+        # The per-crate metrics: the mean correlation of all pairs of channels in the crate
+        # (fCorrMean), the mean correlation of the pairs on the same readout board
+        # (fCorrBoard), and the fraction of the noise power of the crate carried by the
+        # common mode of each readout board (fCoherentFrac), i.e. what the coherent noise
+        # removal takes out. The latter is 1 for fully coherent and 1/64 for independent
+        # channels.
+        CorrMean, CorrBoard, CoherentFrac = [ np.full(len(self.Crates), np.nan) for i in range(3) ]
+        if self.Products is None: return CorrMean, CorrBoard, CoherentFrac
+        for n, Matrix in enumerate(self.Result()):
+            Covariance = self.Covariance(n)
+            Boards = self.BoardOffsets[(self.BoardOffsets >= self.Offsets[n]) & (self.BoardOffsets <= self.Offsets[n+1])] - self.Offsets[n]
+            OffDiagonal = ~np.eye(len(Matrix), dtype=bool)
+            SameBoard = np.zeros_like(OffDiagonal)
+            Common = 0.0
+            for Start, Stop in zip(Boards[:-1], Boards[1:]):
+                SameBoard[Start:Stop,Start:Stop] = True
+                Common += Covariance[Start:Stop,Start:Stop].sum() / (Stop - Start)
+            SameBoard &= OffDiagonal
+            Valid = np.isfinite(Matrix)
+            CorrMean[n] = np.mean(Matrix[OffDiagonal & Valid]) if np.any(OffDiagonal & Valid) else np.nan
+            CorrBoard[n] = np.mean(Matrix[SameBoard & Valid]) if np.any(SameBoard & Valid) else np.nan
+            Total = np.trace(Covariance)
+            CoherentFrac[n] = Common / Total if Total > 0 else np.nan
+        return CorrMean, CorrBoard, CoherentFrac
+
+    def Save(self, FileName, IDs=None):
+        # Writes the correlation matrix of each crate (float32) to a compressed npz file,
+        # under the name of the crate, along with the DAQ channel (fID) of each row if the
+        # IDs of the rows of the channel map are given.
+        Arrays = { str(MiniCrate): Matrix.astype(np.float32) for MiniCrate, Matrix in zip(self.Crates, self.Result()) }
+        if IDs is not None:
+            Arrays.update({ 'fID_' + str(MiniCrate): IDs[self.Order[self.Offsets[n]:self.Offsets[n+1]]] for n, MiniCrate in enumerate(self.Crates) })
+        np.savez_compressed(FileName, **Arrays)
+
+def CoherentNoiseRemoval(Waveforms, Order, Offsets, Pedestals=None):
+    # This function removes the coherent noise from the raw waveforms (nChannels,nTicks) in
+    # memory, emulating the coherent noise subtracted producer. The channels are grouped by
+    # readout board (64 channels): Order is a permutation of the channels sorted by board
+    # and the channels of group g are Order[Offsets[g]:Offsets[g+1]] (see CrateIndex.Boards()).
+    # For each group the pedestal-subtracted waveforms are formed and the median over the
+    # group at each tick is subtracted. Channels without a group (not in the channel map)
+    # are only pedestal-subtracted. Like the stored producer the result is rounded to int16.
+    # The pedestals of the waveforms are found unless they are given.
+    with Span('CoherentRemoval', Channels=len(Waveforms)):
+        if Pedestals is None: Pedestals, RMS = PedestalRMS(Waveforms)
+        Ordered = Waveforms[Order].astype(np.float32)
+        Ordered -= Pedestals[Order].reshape((len(Order),1)).astype(np.float32)
+        for g in range(len(Offsets)-1):
+            Group = Ordered[Offsets[g]:Offsets[g+1]]
+            Group -= np.median(Group, axis=0)
+        Corrected = np.rint(Waveforms - Pedestals.reshape((Pedestals.shape)+(1,))).astype(np.int16)
+        Corrected[Order] = np.rint(Ordered)
+    return Corrected
+
+def AccumulateEvents(RawDigits, Accumulators, Start, Stop, ChunkSize, Groups=None, Convergence=None, Correlation=None):
+    # This function reads the events [Start, Stop) in chunks and hands each to the first
+    # accumulator. If the board Groups (Order, Offsets) are given, the coherent noise is
+    # removed in memory and the corrected waveforms are handed to the second accumulator.
+    # If a CorrelationAccumulator is given, it is handed the same (raw) waveforms as the
+    # first. The pedestals found by the first accumulator are shared with both, so they are
+    # only found once per event. If a ConvergenceMonitor is given, reading stops as soon as
+    # it reports convergence.
+    for n, Waveforms in RawDigits.IterateWaveforms(Stop-Start, ChunkSize, Start=Start):
+        if n % 10 == 0: print('Processing event ' + str(n) + '...')
+        Accumulators[0].Update(Waveforms)
+        if Groups is not None: Accumulators[1].Update(CoherentNoiseRemoval(Waveforms, *Groups, Pedestals=Accumulators[0].Pedestals))
+        if Correlation is not None: Correlation.Update(Waveforms, Pedestals=Accumulators[0].Pedestals)
+        if Convergence is not None and Convergence.Update(Accumulators[0]): break
+    return Accumulators
+
+def NoiseCalcWorker(Task):
+    # This function is run by each worker process of NoiseCalc(). A worker opens its own
+    # handle on the ROOT file (uproot handles cannot be shared between processes) and
+    # accumulates the events in [Start, Stop). The partial sums are returned to the parent
+    # as a list of NoiseAccumulator to be merged, along with the (empty on arrival)
+    # CorrelationAccumulator if there is one.
+    import uproot
+    FileName, Folder, Producer, Exclude, IsRaw, Start, Stop, ChunkSize, Groups, Correlation, Options = Task
+    RawDigits = RawDigit(uproot.open(FileName)[Folder], Producer, Exclude=Exclude)
+    nChannels, nTicks = RawDigits.NumChannels(Start), RawDigits.NumTicks(Start)
+    Accumulators = [ NoiseAccumulator(nChannels, nTicks, IsRaw, **Options) ]
+    if Groups is not None: Accumulators.append(NoiseAccumulator(nChannels, nTicks, False, **Options))
+    return AccumulateEvents(RawDigits, Accumulators, Start, Stop, ChunkSize, Groups, Correlation=Correlation), Correlation
+
+def NoiseCalc(RawDigits, IsRaw, NumEvents=50, ChunkSize=10, Workers=1, Source=None, Groups=None, Convergence=None, Correlation=None, MemoryGB=None, **Options):
+    # This function calculates both the RMS and the power spectrum of each channel as an
+    # average over the number of events, reading each event from the file only once. The
+    # RawDigits argument is an object which serves as an interface to retrieving the raw
+    # digits from the input ROOT file. If Workers > 1 and Source gives the (file name,
+    # events folder) of the ROOT file, the events are spread over a pool of processes, at
+    # most one per event and as many as the partial sums they return fit into MemoryGB (if
+    # given).
+    # If the readout board Groups are given, the metrics after coherent noise removal are
+    # derived from the same waveforms as well (see CoherentNoiseRemoval()). If a
+    # ConvergenceMonitor with a Tolerance is given, the number of events is chosen
+    # adaptively up to its MaxEvents (see ConvergenceMonitor). If a CorrelationAccumulator
+    # is given, the covariance of the channels of each crate is accumulated from the same
+    # waveforms (see CorrelationAccumulator). Any further keyword Options
+    # (DoRMS, DoSpectrum, Engine, BlockSize, Band, Padding, Reach) are passed on to the
+    # NoiseAccumulator.
+
     nChannels = RawDigits.NumChannels(0)               # The number of channels per event.
     nTicks = RawDigits.NumTicks(0)                     # The number of ticks per waveform.
     nEvents = RawDigits.NumEvents()                    # The number of events in the file.
-    RawWaveforms  = np.zeros((nChannels,nTicks))       # Empty array for raw digits.
-    RMS = np.zeros(nChannels)
+    Adaptive = Convergence is not None and Convergence.Tolerance is not None
+    if Adaptive: NumEvents = Convergence.MaxEvents
+    N = NumEvents if NumEvents < nEvents else nEvents
+    Accumulators = [ NoiseAccumulator(nChannels, nTicks, IsRaw, **Options) ]
+    if Groups is not None: Accumulators.append(NoiseAccumulator(nChannels, nTicks, False, **Options))
 
     # Unfortunately it is not possible to do this all at once since there are up to
-    # 55,000 channels and each waveform is 4096 ticks long. This means we need to
-    # perform our calculation in stages. First we determine how many events to include
-    # in the calculation: either the argument of the function or the number in the file,
-    # whichever is smallest. For each event we load up the waveforms, find the pedestal
-    # as the median of the waveform, then subtract the pedestal. The resulting quantity
-    # is squared and added to RawWaveforms. Finally we divide by N to get the 'mean-square'
-    # and take the square root to get the final RMS.
-    N = NumEvents if NumEvents < nEvents else nEvents
-    for n in range(N):
-        if n % 10 == 0: print('Processing (RMS) event ' + str(n) + '...')
-        # Each quantity is (nChannels,nTicks)
-        Waveforms = RawDigits.GetWaveforms(n)
-        #Pedestals = np.median(Waveforms, axis=-1)
-        #WaveLessPeds = Waveforms - Pedestals.reshape((Pedestals.shape)+(1,))
-        #RawWaveforms[:,:] += np.square(WaveLessPeds)
-        RMS += RMSCalcOne(Waveforms)
-    #RawWaveforms /= N
-    RMS /= N
-    #RMS = np.sqrt(np.mean(RawWaveforms,axis=-1))
-  
-    # Now we return RMS, which is a 1D numpy array of length nChannels containing the
-    # RMS value for each channel.
+    # 55,000 channels and each waveform is 4096 ticks long. The events are read from the
+    # file in chunks of ChunkSize events, up to a total of NumEvents or the number in the
+    # file, whichever is smallest, and each is handed to the accumulator as it arrives.
+    # In parallel mode the events are divided into one contiguous range per worker, so
+    # each worker holds (and returns) a single set of partial sums. The ranges are found
+    # independently of ChunkSize (which each worker then reads its range in), snapped to
+    # the baskets of the file where they are small enough, so every worker gets events as
+    # long as there are at least as many events as workers. The workers finish at
+    # about the same time, so all of their partial sums can be in flight at once (tens of
+    # GB for the full detector and many workers). The number of workers is therefore
+    # capped so that the partial sums of all of them fit into MemoryGB.
+    # The adaptive mode decides after every event whether to go on, so it always reads the
+    # events in order in this process.
+    if Workers > 1 and MemoryGB is not None:
+        PartialBytes = sum([ x.Spectrum.nbytes for x in Accumulators if x.DoSpectrum ])
+        if Correlation is not None: PartialBytes += Correlation.Bytes()
+        Cap = max(1, int(MemoryGB * 1024**3 // max(PartialBytes, 1)))
+        if Cap < Workers: logging.info('Using ' + str(Cap) + ' instead of ' + str(Workers) + ' workers to stay within ' + str(MemoryGB) + ' GB.')
+        Workers = min(Workers, Cap)
+    with Span('NoiseCalc', Producer=RawDigits.Producer, Events=int(N), Workers=Workers):
+        if Workers > 1 and Source is not None and N > 1 and not Adaptive:
+            Chunks = RawDigits.ChunkBoundaries(0, N, max(N // Workers, 1))
+            Ranges = [ (c[0][0], c[-1][1]) for c in np.array_split(np.array(Chunks), min(Workers, len(Chunks))) ]
+            if len(Ranges) < Workers: logging.info('Using ' + str(len(Ranges)) + ' instead of ' + str(Workers) + ' workers for the ' + str(N) + ' events.')
+            Tasks = [ (Source[0], Source[1], RawDigits.Producer, RawDigits.Excluded, IsRaw, int(Start), int(Stop), ChunkSize, Groups, Correlation, Options) for Start, Stop in Ranges ]
+            logging.debug('Processing ' + RawDigits.Producer + ' with ' + str(len(Tasks)) + ' workers.')
+            # The workers are spawned rather than forked: a fork of a process which has already
+            # run a parallel numba kernel can deadlock.
+            with multiprocessing.get_context('spawn').Pool(len(Tasks)) as WorkerPool:
+                for Partials, PartialCorrelation in WorkerPool.imap_unordered(NoiseCalcWorker, Tasks):
+                    for Accumulator, Partial in zip(Accumulators, Partials): Accumulator.Merge(Partial)
+                    if Correlation is not None: Correlation.Merge(PartialCorrelation)
+        else:
+            AccumulateEvents(RawDigits, Accumulators, 0, N, ChunkSize, Groups, Convergence, Correlation)
+    if Convergence is not None: Convergence.N = Accumulators[0].N
+    logging.debug('Averaged ' + str(Accumulators[0].N) + ' events of ' + RawDigits.Producer + '.')
+
+    # We return the RMS as a 1D numpy array of length nChannels, the frequencies as a 1D
+    # numpy array, and the power spectrum for each channel as a 2D numpy array of shape
+    # (nChannels,2049), or only the bins of the band if a Band was given. With Groups, the
+    # RMS and power spectrum after coherent noise removal follow.
+    RMS, Frequency, Spectrum = Accumulators[0].Result()
+    if Groups is None: return RMS, Frequency, Spectrum
+    UnRMS, Frequency, UnSpectrum = Accumulators[1].Result()
+    return RMS, Frequency, Spectrum, UnRMS, UnSpectrum
+
+def RMSCalc(RawDigits, NumEvents=50, ChunkSize=10, Workers=1, Source=None):
+    # This function calculates the RMS for each channel and returns an average over the
+    # number of events. The RMS is a 1D numpy array of length nChannels.
+    RMS, Frequency, Spectrum = NoiseCalc(RawDigits, True, NumEvents, ChunkSize, Workers, Source, DoSpectrum=False)
     return RMS
 
-def PowerCalc(RawDigits, IsRaw, NumEvents=50):
+def PowerCalc(RawDigits, IsRaw, NumEvents=50, ChunkSize=10, Workers=1, Source=None, Engine='periodogram', BlockSize=1024):
     # This function calculates the power spectrum of each channel as an average over the
-    # number of events. Again we use a RawDigit object as an interface to the raw digits.
-    
-    nChannels = RawDigits.NumChannels(0)               # The number of channels per event.
-    nTicks = RawDigits.NumTicks(0)                     # The number of ticks per waveform.
-    nEvents = RawDigits.NumEvents()                    # The number of events in the file.
-    Spectrum  = np.zeros((nChannels,2049))             # Empty array for the spectrum.
-    tmpSpectrum = np.zeros((nChannels,2049))           # Temporary array for the spectrum.
-
-    # We first determine the number of events to use for this averaging: either the
-    # number of events from the argument or the number in the ROOT file, whichever is
-    # smallest. Then we begin our calculation by looping over each event. For each event
-    # we retrieve the waveform and, if it's a raw waveform (not coherent noise subtracted)
-    # we subtract the pedestal from the waveform. This would be redundant for the coherent
-    # subtracted waveforms. Then we use the Scipy signal package to calculate the FFT for
-    # each waveform and add it to Spectrum. Finally after looping over each event we divide
-    # Spectrum by the number of events to get the power spectrum averaged over the events
-    # for each channel.
-    N = NumEvents if NumEvents < nEvents else nEvents
-    for n in range(N):
-        if n % 10 == 0: print('Processing (power) event ' + str(n) + '...')
-        # Each quantity below is (nChannels,nTicks).
-        Waveforms = RawDigits.GetWaveforms(n)
-        if IsRaw:
-            Pedestals = np.median(Waveforms, axis=-1)
-            WaveLessPeds = Waveforms - Pedestals.reshape((Pedestals.shape)+(1,))
-            Frequency, tmpSpectrum = signal.periodogram(WaveLessPeds, 1/0.4, axis=1)
-        else: Frequency, tmpSpectrum = signal.periodogram(WaveLessPeds, 1/0.4, axis=1)
-        Spectrum += tmpSpectrum
-    Spectrum /= N 
-
-    # Finally we return the 1D numpy array of the frequencies and the 2D numpy array
-    # containing the power spectrum for each channel (nChannels,2049).
+    # number of events. We return the 1D numpy array of the frequencies and the 2D numpy
+    # array containing the power spectrum for each channel (nChannels,2049).
+    RMS, Frequency, Spectrum = NoiseCalc(RawDigits, IsRaw, NumEvents, ChunkSize, Workers, Source, DoRMS=False, Engine=Engine, BlockSize=BlockSize)
     return Frequency, Spectrum
 
 def MeanPower(Power, Map, MiniCrate):
@@ -98,20 +540,93 @@ def MeanPower(Power, Map, MiniCrate):
     # mini-crate.
     return Spectrum
 
+class CrateIndex:
+    """
+    CrateIndex: Index of the channels belonging to each mini-crate, built once from the channel map dataframe. The
+    rows of the channel map are assumed to be in the same order as the rows of the per-channel arrays (RMS, power
+    spectra) they are used with. The crate-mean spectra are produced by one sparse (nCrates,nChannels) reduction
+    and cached by name, so plotting, peak finding and SNIP can share them.
+    """
+    def __init__(self, Map):
+        """
+        args: Map is the channel map dataframe with (at least) the columns fCrate and fChannel
+        """
+        import scipy.sparse as sparse
+        self.Crates  = np.asarray(Map.fCrate.dropna().unique())
+        Codes        = pd.Categorical(Map.fCrate, categories=self.Crates).codes
+        Valid        = np.flatnonzero(Codes >= 0)
+        self.Counts  = np.bincount(Codes[Valid], minlength=len(self.Crates))
+
+        # The averaging matrix has a weight of 1/nChannels(crate) at (crate, channel) for
+        # every channel in the crate, so that Matrix @ Power is the crate-mean spectrum.
+        self.Matrix  = sparse.csr_matrix((1.0 / self.Counts[Codes[Valid]], (Codes[Valid], Valid)),
+                                         shape=(len(self.Crates), len(Map)))
+
+        # A permutation of the channels sorted by crate and then by 'local' channel number,
+        # with the offsets of each crate in the permutation. The channels of crate n are
+        # then Order[Offsets[n]:Offsets[n+1]].
+        self.Order   = Valid[np.lexsort((Map.fChannel.to_numpy()[Valid], Codes[Valid]))]
+        self.Offsets = np.concatenate(([0], np.cumsum(self.Counts)))
+        self.Cache   = dict()
+
+        # Within each crate the readout boards (64 channels each) are contiguous in the
+        # permutation, so the offsets of the boards are wherever the board changes.
+        Boards       = Codes[self.Order].astype(np.int64) * 1000 + Map.fChannel.to_numpy()[self.Order].astype(np.int64) // 64
+        self.BoardOffsets = np.concatenate(([0], np.flatnonzero(np.diff(Boards)) + 1, [len(self.Order)])) if len(Boards) > 0 else np.zeros(1, dtype=int)
+
+    def Boards(self):
+        # The readout board groups as (Order, Offsets): the channels of board g are
+        # Order[Offsets[g]:Offsets[g+1]].
+        return self.Order, self.BoardOffsets
+
+    def Channels(self, MiniCrate):
+        # The row indices of the channels in the requested mini-crate (e.g. 'WE05'), sorted
+        # by 'local' channel number.
+        n = np.flatnonzero(self.Crates == MiniCrate)[0]
+        return self.Order[self.Offsets[n]:self.Offsets[n+1]]
+
+    def MeanPower(self, Power, Name=None):
+        # The mean power spectrum of every mini-crate as a 2D numpy array (nCrates,nFreq) in
+        # the order of self.Crates. If a Name is given the result is cached under it.
+        if Name is not None and Name in self.Cache: return self.Cache[Name]
+        with Span('CrateMean', Crates=len(self.Crates)):
+            Spectrum = np.asarray(self.Matrix @ Power)
+        if Name is not None: self.Cache[Name] = Spectrum
+        return Spectrum
+
 def PeakFind(Frequency, Power, fLow=1, fHigh=800):
     # This function calculates the frequency (kHz) and height of the peak in the power
-    # spectrum in the range of fLow to FHigh kHz. 
-    
-    # First we create a boolean mask to hone in on the frequency region of interest.
-    # We then apply the range mask and locate the max height of the spectrum in the
-    # region of interest.
-    RangeMask = [ True if x < fHigh and x > fLow else False for x in 1000*Frequency]
-    Power_Selected = Power[RangeMask]
-    ArgMax = np.argmax(Power_Selected)
-    PeakFrequency = 1000*Frequency[RangeMask][ArgMax]
-    PeakPower = Power_Selected[ArgMax]
-    GlobalArgMax = np.argwhere(Power == PeakPower)[0,0]
+    # spectrum in the range of fLow to FHigh kHz. A single spectrum is treated as a batch
+    # of one, see PeakFindBatch().
+    Peaks = PeakFindBatch(Frequency, Power.reshape((1,len(Power))), fLow, fHigh)
     
     # The frequency at which the power spectrum is maximum as well as the peak power
     # are returned.
-    return PeakFrequency, PeakPower, GlobalArgMax
+    return Peaks.fFreq[0], Peaks.fPow[0], Peaks.fArg[0]
+
+def PeakFindBatch(Frequency, Power, fLow=1, fHigh=800, Background=None):
+    # This function locates the peak of each power spectrum (row) of the 2D array Power
+    # (nSpectra,nFreq) in the range of fLow to fHigh kHz, e.g. for every channel at once.
+
+    # The frequencies are sorted, so the region of interest is a contiguous range of bins
+    # which we can find once and then use as a slice. We then locate the max height of
+    # each spectrum in the region of interest and convert back to a global bin index.
+    with Span('PeakFind', Spectra=len(Power)):
+        Band = np.flatnonzero( (1000*Frequency > fLow) & (1000*Frequency < fHigh) )
+        Band = slice(Band[0], Band[-1]+1)
+        Rows = np.arange(Power.shape[0])
+        ArgMax = Band.start + np.argmax(Power[:,Band], axis=1)
+        Peaks = pd.DataFrame({'fFreq': 1000*Frequency[ArgMax],
+                              'fPow': Power[Rows,ArgMax],
+                              'fArg': ArgMax})
+
+        # If the backgrounds (e.g. from the SNIP algorithm) are given, we also separate the
+        # peak power into the part above the background and the background itself.
+        if Background is not None:
+            Peaks['fPowSep'] = Peaks.fPow - Background[Rows,ArgMax]
+            Peaks['fPowBack'] = Background[Rows,ArgMax]
+            Peaks['fRatio'] = Peaks.fPowSep / Peaks.fPowBack
+
+    # Peaks is a dataframe with one row per spectrum containing the peak frequency (kHz),
+    # the peak power, and the global index of the peak bin.
+    return Peaks
@@ -0,0 +1,179 @@
+import numpy as np
+import pandas as pd
+import os
+import re
+import glob
+import time
+import logging
+from RawDigits import RawDigit
+from NoiseCalcTools import NoiseAccumulator, CoherentNoiseRemoval, CrateIndex, PeakFindBatch, BinOffset
+from SpectraTools import BackgroundSNIP, SNIPReach
+from DatabaseTools import BuildMapDataFrame, AlignMap
+from HeatmapTools import PlotHeatmaps
+from OutputTools import WriteMetrics
+
+class OnlineAccumulator:
+    """
+    OnlineAccumulator: Incremental per-channel noise metrics for a run of unknown length. The RMS and power spectrum
+    of each event are found by a NoiseAccumulator and folded into running means with Welford's method, which also
+    tracks the variance of the RMS. The memory used is fixed by the number of channels and ticks, however many
+    events are seen, and the running means do not lose precision as the number of events grows the way sums would.
+    """
+    def __init__(self, nChannels, nTicks, IsRaw=True, **Options):
+        """
+        args: nChannels and nTicks give the shape of the waveforms of each event
+              IsRaw is True if the waveforms still carry a pedestal (not coherent noise subtracted)
+              Options (Engine, BlockSize, SampleRate, Band, Padding, Reach) are passed on to the NoiseAccumulator
+        """
+        self.Event     = NoiseAccumulator(nChannels, nTicks, IsRaw, **Options)
+        self.N         = 0
+        self.RMSMean   = np.zeros(nChannels)
+        self.RMSM2     = np.zeros(nChannels)
+        self.Spectrum  = np.zeros_like(self.Event.Spectrum)
+        self.Frequency = self.Event.Frequency
+
+    def Update(self, Waveforms, BlockSize=1024):
+        # The per-event metrics are left in the sums of the (reset) event accumulator, which
+        # are not changed by the update of the running means. The running spectrum is updated
+        # BlockSize channels at a time, so the temporaries stay small.
+        self.Event.Reset()
+        self.Event.Update(Waveforms)
+        self.N += 1
+        Delta = self.Event.RMS - self.RMSMean
+        self.RMSMean += Delta / self.N
+        self.RMSM2 += Delta * (self.Event.RMS - self.RMSMean)
+        for Start in range(0, len(self.Spectrum), BlockSize):
+            Block = slice(Start, Start + BlockSize)
+            self.Spectrum[Block] += (self.Event.Spectrum[Block] - self.Spectrum[Block]) / self.N
+
+    def Result(self):
+        # The mean RMS, the standard deviation of the RMS over events (NaN for fewer than two
+        # events), the frequencies, and the mean power spectrum of each channel.
+        Std = np.sqrt(self.RMSM2 / (self.N - 1)) if self.N > 1 else np.full(len(self.RMSMean), np.nan)
+        return self.RMSMean, Std, self.Frequency, self.Spectrum
+
+class OnlineMonitor:
+    """
+    OnlineMonitor: Watches a directory for decoded files and updates the noise metrics of the current run with each
+    new event as it appears. Every Refresh events the per-crate metrics and heatmaps are recomputed and written out.
+    A file is read again whenever it changes, starting from the first event not yet seen, so events appended to a
+    file being written are picked up as well as new files. A file of a new run starts a new set of metrics.
+    """
+    def __init__(self, cfg, Directory, Pattern='*-decode.root', Refresh=50, Poll=10):
+        """
+        args: cfg is the analysis configuration (see TPCConfig.yaml)
+              Directory is the directory to watch and Pattern the glob of the decoded files in it
+              Refresh is the number of events between updates of the per-crate metrics and heatmaps
+              Poll is the time in seconds between looks at the directory when there is nothing new
+        """
+        self.cfg       = cfg
+        self.Directory = Directory
+        self.Pattern   = Pattern
+        self.Refresh   = Refresh
+        self.Poll      = Poll
+        self.Seen      = dict()
+        self.Run       = None
+        self.Pending   = 0
+        self.Options   = {'Engine': cfg['Analysis']['SpectrumEngine'], 'BlockSize': cfg['Analysis']['BlockSize']}
+        if cfg['Analysis']['SpectrumMode'] == 'Band':
+            self.Options.update(Band=(cfg['Analysis']['fLow'], cfg['Analysis']['fHigh']), Padding=cfg['Analysis']['BandPadding'], Reach=SNIPReach(20))
+
+    def RunNumber(self, FileName):
+        # The run number is taken from the file name (e.g. data_dl1_run2057_1_...).
+        Match = re.search(r'run(\d+)', os.path.basename(FileName))
+        return int(Match.group(1)) if Match is not None else 0
+
+    def Setup(self, RawDigits, Run):
+        # Builds the channel map, crate index, and accumulators for a new run from its first
+        # file. Masked crates are dropped and the map is aligned with the channels as in
+        # Analyze().
+        ChannelList = RawDigits.GetChannels(0)
+        MapName = self.cfg['Online']['Map']
+        if not os.path.exists(MapName + '.csv'): BuildMapDataFrame(ChannelList, Name=MapName, **self.cfg['HardwareDB'])
+        Dataframe = pd.read_csv(MapName + '.csv')
+        self.Masked = Dataframe.fID[Dataframe.fCrate.isin(self.cfg['Data']['MaskedCrates'] or [])].to_numpy()
+        Dataframe = Dataframe[~Dataframe.fID.isin(self.Masked)].reset_index(drop=True)
+        RawDigits.ExcludeChannels(self.Masked)
+        self.Run          = Run
+        self.ChannelList  = RawDigits.GetChannels(0)
+        self.Map          = AlignMap(Dataframe, self.ChannelList)
+        self.Crates       = CrateIndex(self.Map)
+        nChannels, nTicks = RawDigits.NumChannels(0), RawDigits.NumTicks(0)
+        self.Accumulators = [ OnlineAccumulator(nChannels, nTicks, True, **self.Options),
+                              OnlineAccumulator(nChannels, nTicks, False, **self.Options) ]
+        self.Pending      = 0
+        logging.info('[ OnlineMonitor ]: Monitoring run ' + str(Run) + ' with ' + str(nChannels) + ' channels.')
+
+    def Process(self, FileName):
+        # Reads the events of the file not yet seen and returns how many were processed. A
+        # file which can't be read yet (e.g. still being written) is tried again later.
+        import uproot
+        Run = self.RunNumber(FileName)
+        try:
+            RawDigits = RawDigit(uproot.open(FileName)[self.cfg['Path']['RecoFolder']], self.cfg['Path']['DAQName_Raw'])
+        except Exception as Error:
+            logging.debug('[ OnlineMonitor ]: Could not read ' + FileName + ' yet: ' + repr(Error))
+            return 0
+        if Run != self.Run:
+            if self.Run is not None and self.Pending > 0: self.Update()
+            self.Setup(RawDigits, Run)
+        else:
+            RawDigits.ExcludeChannels(self.Masked)
+        Start = self.Seen.get(FileName, (None, 0))[1]
+        if RawDigits.NumEvents() <= Start: return 0
+        if RawDigits.NumChannels(Start) != len(self.ChannelList):
+            logging.warning('[ OnlineMonitor ]: Skipping ' + FileName + ': the number of channels does not match the run.')
+            self.Seen[FileName] = (os.stat(FileName).st_mtime, RawDigits.NumEvents())
+            return 0
+
+        n = 0
+        for EventNum, Waveforms in RawDigits.IterateWaveforms(None, self.cfg['Analysis']['ChunkSize'], Start=Start):
+            self.Accumulators[0].Update(Waveforms)
+            self.Accumulators[1].Update(CoherentNoiseRemoval(Waveforms, *self.Crates.Boards(), Pedestals=self.Accumulators[0].Event.Pedestals))
+            self.Pending += 1
+            n += 1
+            if self.Pending >= self.Refresh: self.Update()
+        self.Seen[FileName] = (os.stat(FileName).st_mtime, RawDigits.NumEvents())
+        return n
+
+    def Update(self):
+        # Recomputes the per-channel and per-crate metrics from the running means and writes
+        # them to the metrics store (replacing those of the last update) and the heatmaps.
+        RMS, RMSStd, Frequency, PowerRaw = self.Accumulators[0].Result()
+        UnRMS, UnRMSStd, Frequency, PowerUncor = self.Accumulators[1].Result()
+        PowerRaw_Crates = self.Crates.MeanPower(PowerRaw)
+        Background_Crates = BackgroundSNIP(PowerRaw_Crates, nIterations=20, ApplyLLS=True, Offset=BinOffset(Frequency))
+        PowerFrame = PeakFindBatch(Frequency, PowerRaw_Crates, self.cfg['Analysis']['fLow'], self.cfg['Analysis']['fHigh'], Background=Background_Crates)
+        PowerFrame.insert(0, 'fCrate', self.Crates.Crates)
+        PowerFrame.insert(0, 'fRun', self.Run)
+        PowerFrame['fEvents'] = self.Accumulators[0].N
+        PowerFrame = PowerFrame.drop(columns='fArg')
+        Channels = pd.DataFrame({'fID': self.ChannelList, 'fRMS': RMS, 'fRMSStd': RMSStd, 'fUnRMS': UnRMS, 'fUnRMSStd': UnRMSStd})
+        Channels = self.Map.merge(Channels, on='fID', how='left')
+        Channels.insert(0, 'fRun', self.Run)
+        WriteMetrics(Channels, self.cfg['Online']['Path'], 'OnlineChannelMetrics')
+        WriteMetrics(PowerFrame, self.cfg['Online']['Path'], 'OnlineCrateMetrics')
+        PlotHeatmaps(PowerFrame, self.cfg['SVGHeatmap'], Path=self.cfg['Online']['Path'])
+        logging.info('[ OnlineMonitor ]: Updated run ' + str(self.Run) + ' after ' + str(self.Accumulators[0].N) + ' events.')
+        self.Pending = 0
+
+    def Step(self):
+        # One look at the directory: every new or changed file is processed in order of
+        # modification time. Returns the number of events processed.
+        n = 0
+        for FileName in sorted(glob.glob(os.path.join(self.Directory, self.Pattern)), key=os.path.getmtime):
+            if self.Seen.get(FileName, (None, 0))[0] == os.stat(FileName).st_mtime: continue
+            n += self.Process(FileName)
+        return n
+
+    def Watch(self, MaxIdle=None):
+        # Watches the directory until MaxIdle seconds pass without new events (forever if
+        # None). Any events not yet included in an update are flushed at the end.
+        Idle = 0
+        while MaxIdle is None or Idle < MaxIdle:
+            if self.Step() > 0:
+                Idle = 0
+            else:
+                time.sleep(self.Poll)
+                Idle += self.Poll
+        if self.Pending > 0: self.Update()
@@ -0,0 +1,43 @@
+import numpy as np
+import pandas as pd
+import os
+import shutil
+import logging
+from TraceTools import Span
+
+# Channels missing from the hardware database are kept with no mini-crate (fCrate is NaN).
+# Parquet would write them to a partition of nulls which can't be read back, so they are
+# stored under this explicit value instead and turned back into NaN when read.
+UNMAPPED = 'Unmapped'
+
+def WriteMetrics(Frame, Path, Name, PartitionCols=['fRun', 'fCrate']):
+    # This function writes a dataframe of metrics (e.g. per-channel or per-crate) to the
+    # columnar store at Path/Name. The store is a Parquet dataset partitioned by run and
+    # mini-crate, i.e. one directory per run and crate, so later reads can skip everything
+    # but the runs and columns they need. All existing data of the runs being written is
+    # removed first, so a re-analyzed run neither gets duplicates nor keeps the partitions
+    # of crates it no longer has (e.g. after a crate was masked). Missing values of the
+    # partition columns (i.e. unmapped channels) are written as UNMAPPED.
+    Missing = [ Col for Col in PartitionCols if Frame[Col].isna().any() ]
+    if len(Missing) > 0: Frame = Frame.fillna({ Col: UNMAPPED for Col in Missing })
+    with Span('Write', Store=Name, Rows=len(Frame)):
+        for Run in Frame.fRun.unique():
+            Partition = os.path.join(Path, Name, 'fRun=' + str(Run))
+            if os.path.isdir(Partition): shutil.rmtree(Partition)
+        Frame.to_parquet(os.path.join(Path, Name),
+                         partition_cols=PartitionCols,
+                         index=False,
+                         existing_data_behavior='delete_matching')
+    logging.debug('[ WriteMetrics() ]: Wrote ' + str(len(Frame)) + ' rows to ' + os.path.join(Path, Name))
+
+def ReadMetrics(Path, Name, Columns=None, Runs=None):
+    # This function reads the requested Columns (or all of them if None) of the metrics
+    # store at Path/Name, optionally only for the requested Runs. Only the matching
+    # partitions and columns are read from disk. The partition columns come back as
+    # categories, so they are converted back to plain values, and the unmapped channels get
+    # their missing mini-crate back.
+    Filters = [ ('fRun', 'in', list(Runs)) ] if Runs is not None else None
+    Frame = pd.read_parquet(os.path.join(Path, Name), columns=Columns, filters=Filters)
+    if 'fRun' in Frame.columns: Frame['fRun'] = Frame.fRun.astype(np.int64)
+    if 'fCrate' in Frame.columns: Frame['fCrate'] = Frame.fCrate.astype(str).replace(UNMAPPED, np.nan)
+    return Frame
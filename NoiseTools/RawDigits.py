@@ -3,6 +3,7 @@
 # numpy is the source of all life in python
 import numpy as np
 import logging
+from TraceTools import Span
 
 # An object for handling RawDigits from art root files
 
@@ -12,17 +13,37 @@ class RawDigit:
     "events" folder in the input root file which contains the RawDigits per event. We can then access each by 
     event number 
     """
-    def __init__(self, EventsFolder, Producer):
+    def __init__(self, EventsFolder, Producer, Exclude=None):
         """
         args: EventsFolder is the folder containing the desired RawDigits by event
               Producer is the path to the RawDigits for uproot to decode when looking them up
+              Exclude is an optional list of channel numbers to drop (e.g. the channels of masked crates)
         """
         self.EventsFolder = EventsFolder
         self.Producer     = Producer
         self.Obj          = EventsFolder.array(self.Producer+"obj",flatten=True)
-        self.Mask         = [ False if x > 56000 else True for x in self.GetChannels(0, FullList=True) ]
+        self.Ticks        = dict()
+        self.ExcludeChannels(Exclude)
+
+    def ExcludeChannels(self, Exclude=None):
+        """
+        Plan: Build the plan for selecting the good channels out of the decoded fADC block of an event. Channels above
+              56000 are empty and always masked, and any channels in Exclude are dropped as well. The plan is worked
+              out once here: if the selected channels form one contiguous range (e.g. when the masked channels are
+              grouped at the end) it is a slice, so each event is a view into the decoded buffer rather than a copy.
+              Otherwise it is an index array.
+        """
+        Channels          = np.asarray(self.GetChannels(0, FullList=True))
+        self.Excluded     = np.array([] if Exclude is None else Exclude, dtype=Channels.dtype)
+        self.Mask         = (Channels <= 56000) & ~np.isin(Channels, self.Excluded)
         self.EmptyCount   = np.size(self.Mask) - np.count_nonzero(self.Mask)
+        Index             = np.flatnonzero(self.Mask)
+        if len(Index) > 0 and Index[-1] - Index[0] + 1 == len(Index):
+            self.Selection = slice(Index[0], Index[-1]+1)
+        else:
+            self.Selection = Index
         logging.debug('There are ' + str(self.EmptyCount) + ' masked channels.')
+        logging.debug('Channel selection is ' + ('a view.' if isinstance(self.Selection, slice) else 'a copy.'))
 
     def NumEvents(self):
         numEvents = len(self.Obj)
@@ -34,8 +55,12 @@ class RawDigit:
         return int(nChannels)
     
     def NumTicks(self, EventNum, ChannelNum=0):
-        samples = self.EventsFolder.array(self.Producer+"obj.fSamples",entrystart=EventNum,entrystop=EventNum+1,flatten=True)
-        return int(samples[ChannelNum])
+        # The number of samples only needs to be read from the file once per event, after
+        # which it is served from the cache.
+        if EventNum not in self.Ticks:
+            with Span('Read', Branch='fSamples'):
+                self.Ticks[EventNum] = self.EventsFolder.array(self.Producer+"obj.fSamples",entrystart=EventNum,entrystop=EventNum+1,flatten=True)
+        return int(self.Ticks[EventNum][ChannelNum])
     
     def GetWaveforms(self, EventNum):
         """
@@ -46,14 +71,64 @@ class RawDigit:
         """
         # First check to see if this event has an entry (can happen in multiTPC readout)
         if self.NumChannels(EventNum) > 0:
-            nTicks    = self.NumTicks(EventNum)
-            nChannels = self.NumChannels(EventNum)
-            Waveforms = self.EventsFolder.array(self.Producer+"obj.fADC",entrystart=EventNum,entrystop=EventNum+1,flatten=True)[0]
-            return np.array(Waveforms)[self.Mask]
+            with Span('Read', Branch='fADC', Events=1):
+                Waveforms = self.EventsFolder.array(self.Producer+"obj.fADC",entrystart=EventNum,entrystop=EventNum+1,flatten=True)[0]
+            return np.asarray(Waveforms, dtype=np.int16)[self.Selection]
         else:
-            return numpy.zeros(shape=(1,1))
+            return np.zeros(shape=(1,1), dtype=np.int16)
+
+    def ChunkBoundaries(self, Start, Stop, ChunkSize):
+        """
+        Plan: Split the events [Start, Stop) into ranges of at most ChunkSize events each. Where the fADC branch
+              exposes its basket layout the boundaries are snapped to the end of a basket, so that no basket has to
+              be decompressed twice by neighbouring chunks.
+        """
+        ChunkSize = max(int(ChunkSize), 1)
+        Stops = list()
+        try:
+            Branch = self.EventsFolder[self.Producer+"obj.fADC"]
+            Stops = [ Branch.basket_entrystop(i) for i in range(Branch.numbaskets) ]
+        except (AttributeError, KeyError, TypeError):
+            logging.debug('No basket layout available for ' + self.Producer + '. Using fixed chunks.')
+        Stops = sorted(set([ s for s in Stops if Start < s < Stop ] + [ Stop ]))
+
+        # Whole baskets are grouped into a chunk for as long as the chunk stays within
+        # ChunkSize events. A basket which is by itself larger than ChunkSize is split.
+        Boundaries = list()
+        BasketStart = Start
+        for BasketStop in Stops:
+            if BasketStop - Start > ChunkSize and BasketStart > Start:
+                Boundaries.append((Start, BasketStart))
+                Start = BasketStart
+            while BasketStop - Start > ChunkSize:
+                Boundaries.append((Start, Start+ChunkSize))
+                Start += ChunkSize
+            BasketStart = BasketStop
+        if Stop > Start: Boundaries.append((Start, Stop))
+        return Boundaries
+
+    def IterateWaveforms(self, NumEvents=None, ChunkSize=10, Start=0):
+        """
+        Plan: Generator over events yielding (EventNum, Waveforms) with Waveforms a (nChannels, nTicks) int16 array.
+              Rather than asking uproot for one entry of fADC at a time, a whole chunk of events is read with a single
+              call so that the decompression and call overhead is shared by every event in the chunk. Events without
+              any RawDigits (possible in multiTPC readout) are skipped, so callers should count what they receive.
+        """
+        Stop = self.NumEvents() if NumEvents is None else min(Start + NumEvents, self.NumEvents())
+        for ChunkStart, ChunkStop in self.ChunkBoundaries(Start, Stop, ChunkSize):
+            # The read span covers both reading and decompressing the baskets, which uproot
+            # does in the same call.
+            with Span('Read', Branch='fADC', Events=ChunkStop-ChunkStart):
+                Block = self.EventsFolder.array(self.Producer+"obj.fADC",entrystart=ChunkStart,entrystop=ChunkStop,flatten=True)
+            for EventNum in range(ChunkStart, ChunkStop):
+                if self.NumChannels(EventNum) > 0:
+                    yield EventNum, np.asarray(Block[EventNum-ChunkStart], dtype=np.int16)[self.Selection]
+                else:
+                    logging.debug('Skipping event ' + str(EventNum) + ' of ' + self.Producer + ': no RawDigits.')
+            del Block
         
     def GetChannels(self, EventNum, FullList=False):
-        channels = self.EventsFolder.array(self.Producer+"obj.fChannel",entrystart=EventNum,entrystop=EventNum+1,flatten=True)
-        if not FullList: channels = channels[self.Mask]
+        with Span('Read', Branch='fChannel'):
+            channels = self.EventsFolder.array(self.Producer+"obj.fChannel",entrystart=EventNum,entrystop=EventNum+1,flatten=True)
+        if not FullList: channels = np.asarray(channels)[self.Selection]
         return channels
@@ -0,0 +1,103 @@
+import os
+import json
+import time
+import logging
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+
+class RunScheduler:
+    """
+    RunScheduler: Processes a list of runs in two pipelined stages. The first stage (Source) produces the decoded
+    file of a run, e.g. by launching a decode job, and the second stage (Process) analyzes it. The decoding of the
+    next runs overlaps with the analysis of the current one. The status of each run is kept in a JSON state file so
+    a rerun skips the runs which are already complete.
+    """
+    def __init__(self, Source, Process, StateFile='SchedulerState.json', DecodeWorkers=1, Lookahead=1):
+        """
+        args: Source is a function taking a run and returning the path of its decoded file
+              Process is a function taking a run and the path of its decoded file and returning its results
+              StateFile is the JSON file holding the status of each run
+              DecodeWorkers is the maximum number of runs decoded at once
+              Lookahead is the maximum number of runs decoded ahead of the run being analyzed
+        Plan: The decode jobs are external processes, so they are run from a small thread pool. The analysis is run
+              in the calling process one run at a time, as it already uses every core through its own workers.
+              A failure in either stage is recorded for that run and the remaining runs continue.
+        """
+        self.Source        = Source
+        self.Process       = Process
+        self.StateFile     = StateFile
+        self.DecodeWorkers = DecodeWorkers
+        self.Lookahead     = max(Lookahead, 1)
+        self.State         = self.Load()
+
+    def Load(self):
+        # Reads the state file, if it exists. The keys are the runs as strings.
+        if not os.path.exists(self.StateFile): return dict()
+        with open(self.StateFile, 'r') as File:
+            return json.load(File)
+
+    def Save(self):
+        # The state is written to a temporary file which is then renamed into place, so an
+        # interrupted write never leaves a corrupt state file behind.
+        Temporary = self.StateFile + '.tmp'
+        with open(Temporary, 'w') as File:
+            json.dump(self.State, File, indent=2, sort_keys=True)
+        os.replace(Temporary, self.StateFile)
+
+    def Update(self, Run, **Fields):
+        self.State.setdefault(str(Run), dict()).update(Fields, Time=time.time())
+        self.Save()
+
+    def Status(self, Run):
+        return self.State.get(str(Run), dict()).get('Status')
+
+    def Completed(self, Runs):
+        # Returns the runs in Runs which have been completed (in this or a previous pass).
+        return [ Run for Run in Runs if self.Status(Run) == 'Complete' ]
+
+    def Failed(self, Runs):
+        return [ Run for Run in Runs if self.Status(Run) == 'Failed' ]
+
+    def Decode(self, Run):
+        # The decode stage of a single run. Runs decoded in a previous pass (e.g. whose analysis
+        # failed) are not decoded again if their file still exists.
+        Previous = self.State.get(str(Run), dict()).get('File')
+        if Previous is not None and os.path.exists(Previous): return Previous
+        Start = time.time()
+        File = self.Source(Run)
+        if File is None: raise RuntimeError('No decoded file returned for run ' + str(Run))
+        logging.debug('[ RunScheduler ]: Decoded run ' + str(Run) + ' in ' + str(round(time.time() - Start, 1)) + ' s')
+        return File
+
+    def Run(self, Runs):
+        # Processes the runs in order and returns a dictionary of the results of the runs
+        # analyzed in this pass. Runs already complete are skipped.
+        Pending = [ Run for Run in Runs if self.Status(Run) != 'Complete' ]
+        logging.info('[ RunScheduler ]: ' + str(len(Runs) - len(Pending)) + ' runs already complete, ' + str(len(Pending)) + ' to process.')
+        Results = dict()
+        with ThreadPoolExecutor(max_workers=self.DecodeWorkers) as Executor:
+            # At most Lookahead runs beyond the one being analyzed are submitted for decoding.
+            Decoding = [ (Run, Executor.submit(self.Decode, Run)) for Run in Pending[:self.Lookahead+1] ]
+            Next = len(Decoding)
+            while len(Decoding) > 0:
+                Run, Future = Decoding.pop(0)
+                while len(Decoding) < self.Lookahead and Next < len(Pending):
+                    Decoding.append((Pending[Next], Executor.submit(self.Decode, Pending[Next])))
+                    Next += 1
+                try:
+                    File = Future.result()
+                except Exception as Error:
+                    logging.error('[ RunScheduler ]: Decoding run ' + str(Run) + ' failed: ' + repr(Error))
+                    self.Update(Run, Status='Failed', Stage='Decode', Error=repr(Error))
+                    continue
+                self.Update(Run, Status='Decoded', File=File)
+                try:
+                    Start = time.time()
+                    Results[Run] = self.Process(Run, File)
+                except Exception as Error:
+                    logging.error('[ RunScheduler ]: Analysis of run ' + str(Run) + ' failed: ' + repr(Error) + '\n' + traceback.format_exc())
+                    self.Update(Run, Status='Failed', Stage='Analyze', Error=repr(Error))
+                    continue
+                self.Update(Run, Status='Complete', Seconds=round(time.time() - Start, 1))
+                logging.info('[ RunScheduler ]: Completed run ' + str(Run))
+        return Results
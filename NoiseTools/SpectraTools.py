@@ -1,9 +1,10 @@
 import numpy as np
 import pandas as pd
-from numba import njit
+from numba import njit, prange
+from TraceTools import Span
 
-@njit
-def BackgroundSNIPCalc(Power, nIterations=20, ApplyLLS=False, ProtectRange=100, ProtectIterations=5):
+@njit(cache=True)
+def BackgroundSNIPCalc(Power, nIterations=20, ApplyLLS=False, ProtectRange=100, ProtectIterations=5, Offset=0):
     # This function takes an input power spectrum and attempts to calculate the background
     # (i.e. everything that is 'smooth' and not a peak). This is done following the 1D
     # Sensitive Nonlinear Iterative Peak (SNIP) clipping algorithm. The inputs to this are
@@ -11,33 +12,68 @@ def BackgroundSNIPCalc(Power, nIterations=20, ApplyLLS=False, ProtectRange=100,
     # Log-Log-Square root operator. This has the benefit of enhancing relatively small
     # peaks in the spectrum, though in some cases this may be undesirable (too sensitive).
 
-    # First we create an empty numpy array that is meant to store each of the steps of the
-    # iteration process. Afterwards we apply the LLS operator if desired.
-    Iterations = np.empty((nIterations+1,len(Power)))
-    if ApplyLLS: Iterations[0,:] = np.log( np.log( np.sqrt(Power + 1) + 1 ) + 1 )
-    else: Iterations[0,:] = Power
-    
-    # Unfortunately I couldn't think of a pythonic way to do this elegantly. This is
-    # immensely disatisfying, but it does appear to work okay. Fortunately this isn't being
-    # used on any very large arrays where performance is important. Anyway, we begin the
-    # iteration process. Essentially we are performing a 'smoothing' by looking at the
-    # minimum of the current point and the average of its neighbors (not necessarily its
-    # adjacent neighbors).
-    for n in range(1,nIterations+1):
-        for j in range(1, len(Power)):
-            nProtect = n if n < 5 else ProtectRange
-            if j >= nProtect and j+n < len(Power):
-                Iterations[n,j] = min( (Iterations[n-1,j-n] + Iterations[n-1,j+n])/2.0,
-                                       Iterations[n-1, j])
-            else:
-                Iterations[n,j] = Iterations[n-1,j]
-
-    BG = Iterations[-1]
-    if ApplyLLS: BG = np.square( np.exp( ( np.exp(BG) - 1 ) ) - 1 ) - 1
-
-    # The last iteration should contain the best estimate for the background of the power
-    # spectrum. Note that the more iterations are used, the 'smoother' the background
-    # gets and more variation tends to get thrown out. In any case, this is our final
-    # result
+    # The single spectrum is simply treated as a batch of one. See BackgroundSNIPCalcBatch()
+    # for the details of the algorithm.
+    Batch = BackgroundSNIPCalcBatch(np.ascontiguousarray(Power).reshape((1,len(Power))),
+                                    nIterations, ApplyLLS, ProtectRange, ProtectIterations, Offset)
+    return Batch[0]
+
+@njit(parallel=True, cache=True)
+def BackgroundSNIPCalcBatch(Power, nIterations=20, ApplyLLS=False, ProtectRange=100, ProtectIterations=5, Offset=0):
+    # This function applies the SNIP background estimation to every row of a 2D array of
+    # power spectra (nSpectra,nFreq) at once, e.g. the spectrum of every channel. The
+    # spectra are independent of each other, so numba spreads them over all cores. If the
+    # spectra are band-limited, Offset is the index of their first bin in the full spectrum
+    # so the protected bins (which are counted from DC) stay the same.
+
+    nSpectra, nFreq = Power.shape
+    BG = np.empty((nSpectra,nFreq))
+    for s in prange(nSpectra):
+        # Only the previous iteration is ever needed to calculate the next one, so rather
+        # than storing each of the steps of the iteration process we keep two rolling
+        # buffers and swap them after each iteration. First we apply the LLS operator if
+        # desired.
+        Previous = np.empty(nFreq)
+        Current = np.empty(nFreq)
+        for j in range(nFreq):
+            if ApplyLLS: Previous[j] = np.log( np.log( np.sqrt(Power[s,j] + 1) + 1 ) + 1 )
+            else: Previous[j] = Power[s,j]
+
+        # Now the iteration process. Essentially we are performing a 'smoothing' by looking
+        # at the minimum of the current point and the average of its neighbors (not
+        # necessarily its adjacent neighbors). For the first ProtectIterations iterations
+        # only the first n bins are protected from clipping, afterwards the first
+        # ProtectRange bins are.
+        for n in range(1,nIterations+1):
+            nProtect = n if n < ProtectIterations else ProtectRange
+            Current[0] = Previous[0]
+            for j in range(1, nFreq):
+                if j+Offset >= nProtect and j >= n and j+n < nFreq:
+                    Current[j] = min( (Previous[j-n] + Previous[j+n])/2.0, Previous[j] )
+                else:
+                    Current[j] = Previous[j]
+            Previous, Current = Current, Previous
+
+        # The last iteration should contain the best estimate for the background of the power
+        # spectrum. Note that the more iterations are used, the 'smoother' the background
+        # gets and more variation tends to get thrown out. In any case, this is our final
+        # result once the LLS operator has been undone.
+        for j in range(nFreq):
+            if ApplyLLS: BG[s,j] = np.square( np.exp( ( np.exp(Previous[j]) - 1 ) ) - 1 ) - 1
+            else: BG[s,j] = Previous[j]
     return BG
 
+def SNIPReach(nIterations=20):
+    # This function returns how many bins away from a bin the SNIP background of that bin
+    # can depend on: iteration n compares each bin with the bins n away, so after all the
+    # iterations the reach is 1 + 2 + ... + nIterations bins on either side. A band-limited
+    # spectrum needs at least this many bins of padding for its background to be the same
+    # as that of the full spectrum.
+    return nIterations*(nIterations+1)//2
+
+def BackgroundSNIP(Power, **Options):
+    # This function finds the SNIP background of each row of the 2D array Power (see
+    # BackgroundSNIPCalcBatch(), which takes the same keyword Options) and records the time
+    # taken as a span of the trace.
+    with Span('SNIP', Spectra=len(Power)):
+        return BackgroundSNIPCalcBatch(Power, **Options)
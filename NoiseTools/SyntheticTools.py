@@ -0,0 +1,86 @@
+import numpy as np
+import pandas as pd
+from HeatmapTools import MiniCrateList
+
+class SyntheticBranch:
+    """
+    SyntheticBranch: Stand-in for an uproot branch which only exposes the basket layout (a fixed number of events per
+    basket), so that RawDigit.ChunkBoundaries() can be exercised.
+    """
+    def __init__(self, nEvents, BasketSize):
+        self.nEvents    = nEvents
+        self.BasketSize = BasketSize
+        self.numbaskets = -(-nEvents // BasketSize)
+
+    def basket_entrystop(self, i):
+        return min((i+1) * self.BasketSize, self.nEvents)
+
+class SyntheticEvents:
+    """
+    SyntheticEvents: Stand-in for the "Events" folder of a decoded ROOT file as read by uproot, serving synthetic
+    RawDigits so the analysis chain can be run (and timed) without real data. Each waveform is a pedestal plus white
+    noise, a noise component shared by all channels of the same readout board (coherent noise), and narrow-band lines
+    at the requested frequencies. A few empty channels above 56000 are appended as in the real readout.
+    """
+    def __init__(self, nChannels=576, nTicks=4096, nEvents=10, Noise=3.0, Coherent=2.0, Lines=[(120, 1.5)], nEmpty=8,
+                 BasketSize=5, SampleRate=1/0.4, Seed=0):
+        """
+        args: nChannels, nTicks and nEvents give the size of the data set
+              Noise is the RMS of the white noise of each channel in ADC counts
+              Coherent is the RMS of the noise shared by the 64 channels of each readout board in ADC counts
+              Lines is a list of (frequency in kHz, amplitude in ADC counts) of narrow-band noise on every channel
+              nEmpty is the number of empty channels (numbered above 56000) appended to each event
+              BasketSize is the number of events per basket of the fADC branch
+              SampleRate is the digitization frequency in MHz
+              Seed seeds the random numbers, so the same event always has the same waveforms
+        Plan: The events are generated on demand from a per-event seed rather than stored, so the memory used does
+              not grow with the number of events.
+        """
+        self.nChannels  = nChannels
+        self.nTicks     = nTicks
+        self.nEvents    = nEvents
+        self.Noise      = Noise
+        self.Coherent   = Coherent
+        self.Lines      = Lines
+        self.BasketSize = BasketSize
+        self.SampleRate = SampleRate
+        self.Seed       = Seed
+        self.Channels   = np.concatenate((np.arange(nChannels), 56001 + np.arange(nEmpty)))
+        self.Pedestals  = np.random.default_rng(Seed).integers(400, 2100, len(self.Channels))
+
+    def Event(self, EventNum):
+        # Returns the fADC block (nChannels+nEmpty,nTicks) of the event as int16.
+        Random = np.random.default_rng((self.Seed, EventNum))
+        Waveforms = Random.normal(0, self.Noise, (len(self.Channels), self.nTicks)).astype(np.float32)
+        Boards = -(-len(self.Channels) // 64)
+        Shared = Random.normal(0, self.Coherent, (Boards, self.nTicks)).astype(np.float32)
+        Waveforms += np.repeat(Shared, 64, axis=0)[:len(self.Channels)]
+        Time = np.arange(self.nTicks) / self.SampleRate
+        for Frequency, Amplitude in self.Lines:
+            Phase = Random.uniform(0, 2*np.pi)
+            Waveforms += (Amplitude * np.sin(2*np.pi*Frequency/1000*Time + Phase)).astype(np.float32)
+        Waveforms += self.Pedestals.reshape((len(self.Channels),1))
+        Waveforms[self.nChannels:] = 0
+        return np.rint(Waveforms).astype(np.int16)
+
+    def array(self, Name, entrystart=None, entrystop=None, flatten=False):
+        # Emulates EventsFolder.array() for the branches RawDigit reads.
+        Start = 0 if entrystart is None else entrystart
+        Stop = self.nEvents if entrystop is None else entrystop
+        if Name.endswith('obj'): return np.full(Stop - Start, len(self.Channels))
+        if Name.endswith('obj.fSamples'): return np.full((Stop - Start) * len(self.Channels), self.nTicks)
+        if Name.endswith('obj.fChannel'): return np.tile(self.Channels, Stop - Start)
+        if Name.endswith('obj.fADC'): return np.stack([ self.Event(n) for n in range(Start, Stop) ])
+        raise KeyError(Name)
+
+    def __getitem__(self, Name):
+        if Name.endswith('obj.fADC'): return SyntheticBranch(self.nEvents, self.BasketSize)
+        raise KeyError(Name)
+
+def SyntheticMap(Events):
+    # This function returns a channel map (fID, fChannel, fCrate) for the synthetic channels.
+    # The channels are assigned in order to the mini-crates of the detector, 576 channels
+    # (nine readout boards) per mini-crate, so the readout boards match the coherent noise.
+    Channels = np.arange(Events.nChannels)
+    Crates = np.array(MiniCrateList)[ (Channels // 576) % len(MiniCrateList) ]
+    return pd.DataFrame({'fID': Channels, 'fChannel': Channels % 576, 'fCrate': Crates})
@@ -0,0 +1,119 @@
+import os
+import time
+import json
+import resource
+import cProfile
+import contextlib
+import logging
+
+def ReadBytes():
+    # The number of bytes this process has read so far (including reads served from the page
+    # cache), or 0 where /proc/self/io is not available.
+    try:
+        with open('/proc/self/io', 'r') as IO:
+            for Line in IO:
+                if Line.startswith('rchar:'): return int(Line.split()[1])
+    except OSError:
+        pass
+    return 0
+
+def CurrentRSS():
+    # The resident set size of this process in bytes, or 0 where /proc is not available.
+    try:
+        with open('/proc/self/statm', 'r') as Statm:
+            return int(Statm.read().split()[1]) * resource.getpagesize()
+    except OSError:
+        return 0
+
+class Tracer:
+    """
+    Tracer: Records the spans of a run (read, pedestal, FFT, SNIP, peak-find, plot, write, ...) with their wall and CPU
+    time (own and of finished child processes), the bytes read, the resident set size at their end and its high-water
+    mark. Every span adds to a per-name summary; the individual spans are kept up to MaxSpans. Spans named in Profile
+    are also run under cProfile, with the statistics written next to the trace. A disabled tracer records nothing and
+    its spans cost next to nothing, so the instrumentation can stay in the hot loops.
+    """
+    def __init__(self):
+        self.Enabled = False
+        self.Reset()
+
+    def Reset(self, Profile=(), ProfilePath='./', MaxSpans=10000, **Metadata):
+        self.Metadata    = Metadata
+        self.Profile     = set(Profile or ())
+        self.ProfilePath = ProfilePath
+        self.MaxSpans    = MaxSpans
+        self.Spans       = list()
+        self.Summary     = dict()
+        self.Stack       = list()
+        self.Dropped     = 0
+        self.Origin      = time.perf_counter()
+        self.Profiler    = None
+
+    def Start(self, **Options):
+        # Starts a new trace. The Options are those of Reset(), and anything else (e.g. the
+        # run number) is stored as metadata of the trace.
+        self.Reset(**Options)
+        if len(self.Profile) > 0: os.makedirs(self.ProfilePath, exist_ok=True)
+        self.Enabled = True
+
+    def Stop(self):
+        self.Enabled = False
+
+    @contextlib.contextmanager
+    def Span(self, Name, **Attributes):
+        # Records the enclosed block as a span. Spans may be nested, and each records the
+        # name of its parent. Any keyword Attributes (e.g. the number of events) are stored
+        # with the span.
+        if not self.Enabled:
+            yield
+            return
+        Parent = self.Stack[-1] if len(self.Stack) > 0 else None
+        self.Stack.append(Name)
+        Profiling = Name in self.Profile and self.Profiler is None
+        if Profiling:
+            self.Profiler = cProfile.Profile()
+            self.Profiler.enable()
+        Children = resource.getrusage(resource.RUSAGE_CHILDREN)
+        Read = ReadBytes()
+        CPU = time.process_time()
+        Start = time.perf_counter()
+        try:
+            yield
+        finally:
+            Wall = time.perf_counter() - Start
+            CPU = time.process_time() - CPU
+            Read = ReadBytes() - Read
+            Usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+            ChildCPU = (Usage.ru_utime + Usage.ru_stime) - (Children.ru_utime + Children.ru_stime)
+            MaxRSS = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+            if Profiling:
+                self.Profiler.disable()
+                self.Profiler.dump_stats(os.path.join(self.ProfilePath, 'Profile_' + Name + '_' + str(len(self.Spans)) + '.prof'))
+                self.Profiler = None
+            self.Stack.pop()
+            Record = {'Name': Name, 'Parent': Parent, 'Depth': len(self.Stack), 'Start': Start - self.Origin, 'Wall': Wall, 'CPU': CPU,
+                      'ChildCPU': ChildCPU, 'ReadBytes': Read, 'RSS': CurrentRSS(), 'MaxRSS': MaxRSS}
+            Record.update(Attributes)
+            if len(self.Spans) < self.MaxSpans: self.Spans.append(Record)
+            else: self.Dropped += 1
+            Summary = self.Summary.setdefault(Name, {'Count': 0, 'Wall': 0.0, 'CPU': 0.0, 'ChildCPU': 0.0, 'ReadBytes': 0, 'MaxRSS': 0})
+            Summary['Count'] += 1
+            Summary['Wall'] += Wall
+            Summary['CPU'] += CPU
+            Summary['ChildCPU'] += ChildCPU
+            Summary['ReadBytes'] += Read
+            Summary['MaxRSS'] = max(Summary['MaxRSS'], MaxRSS)
+
+    def Save(self, FileName):
+        # Writes the trace (metadata, per-name summary, and the individual spans) as JSON.
+        Directory = os.path.dirname(FileName)
+        if Directory != '': os.makedirs(Directory, exist_ok=True)
+        with open(FileName, 'w') as File:
+            json.dump({'Metadata': self.Metadata, 'Summary': self.Summary, 'Spans': self.Spans, 'Dropped': self.Dropped}, File, indent=1, default=str)
+        logging.debug('[ Tracer ]: Wrote trace with ' + str(len(self.Spans)) + ' spans to ' + FileName)
+
+# The tracer shared by the whole toolkit. It is disabled until a trace is started.
+TRACER = Tracer()
+
+def Span(Name, **Attributes):
+    return TRACER.Span(Name, **Attributes)
@@ -0,0 +1,24 @@
+# Python includes
+import sys
+import logging
+import signal as sg
+
+# Custom includes
+sys.path.insert(0, './NoiseTools/')
+from NoiseHelperTools import SigintHandler, ReturnConfig
+from OnlineTools import OnlineMonitor
+
+def main():
+    # Online monitoring: the decoded files appearing in the watched directory are analyzed
+    # event by event while the run is still being taken, and the per-crate metrics and
+    # heatmaps are refreshed every RefreshEvents events (see the Online configuration).
+    sg.signal(sg.SIGINT, SigintHandler)
+    cfg = ReturnConfig('TPCConfig.yaml')
+    logging.basicConfig(filename=cfg['Miscellaneous']['LogPath'] + 'Online' + cfg['Miscellaneous']['LogName'], level=logging.DEBUG, filemode='w')
+    logging.warning('Logging service has started.')
+
+    Monitor = OnlineMonitor(cfg, cfg['Online']['Directory'], Pattern=cfg['Online']['Pattern'], Refresh=cfg['Online']['RefreshEvents'], Poll=cfg['Online']['Poll'])
+    Monitor.Watch(MaxIdle=cfg['Online']['MaxIdle'])
+
+if __name__ == "__main__":
+    main()
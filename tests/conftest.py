@@ -0,0 +1,6 @@
+import os
+import sys
+
+# The modules of the toolkit import each other by name, just as when they are run with
+# './NoiseTools/' on the path, so the tests do the same.
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'NoiseTools'))
@@ -0,0 +1,28 @@
+import os
+from CatalogTools import RunCatalog, FakeBackend
+from NoiseHelperTools import Decode
+
+# Run 2057 has one file from each of the two DataLoggers. Only the DataLogger1 file is
+# located and decoded. The decode job is replaced by a command creating the decoded file.
+RUNS = {2057: {'data_dl1_run2057_1_20200101T000000.root': '/pnfs/icarus/raw/2057',
+               'data_dl2_run2057_2_20200101T000000.root': '/pnfs/icarus/raw/2057'}}
+COMMAND = 'touch data_dl1_run2057_1_20200101T000000-decode.root'
+
+def test_RepeatedDecode(tmp_path, monkeypatch):
+    # The first decode looks up the files of the run and locates the selected one. A
+    # repeated decode, also through a new catalog read back from disk, makes no lookups.
+    monkeypatch.chdir(tmp_path)
+    Backend = FakeBackend(RUNS)
+    Catalog = RunCatalog(str(tmp_path / 'RunCatalog.json'), Backend=Backend)
+    Decoded = Decode('2057', Command=COMMAND, Catalog=Catalog)
+    assert os.path.exists(Decoded)
+    assert Backend.Lookups == 2
+
+    Backend.Lookups = 0
+    assert Decode('2057', Command=COMMAND, Catalog=Catalog) == Decoded
+    assert Backend.Lookups == 0
+
+    Backend = FakeBackend(RUNS)
+    Catalog = RunCatalog(str(tmp_path / 'RunCatalog.json'), Backend=Backend)
+    assert Decode('2057', Command=COMMAND, Catalog=Catalog) == Decoded
+    assert Backend.Lookups == 0
@@ -0,0 +1,92 @@
+import threading
+import urllib.parse
+import urllib.request
+import http.server
+import pandas as pd
+import pytest
+import DatabaseTools
+
+# The hardware database tables served by the stand-in frontend. The readout board 11 row
+# is repeated, as happens when a board is entered twice, so its channels appear twice in
+# the joined map.
+TABLES = {'daq_channels': [ {'channel_id': '0', 'readout_board_id': '10', 'readout_board_slot': '0', 'channel_number': '0'},
+                            {'channel_id': '1', 'readout_board_id': '10', 'readout_board_slot': '0', 'channel_number': '1'},
+                            {'channel_id': '64', 'readout_board_id': '11', 'readout_board_slot': '1', 'channel_number': '0'} ],
+          'readout_boards': [ {'readout_board_id': '10', 'flange_id': '100'},
+                              {'readout_board_id': '11', 'flange_id': '101'},
+                              {'readout_board_id': '11', 'flange_id': '101'} ],
+          'flanges': [ {'flange_id': '100', 'flange_pos_at_chimney': 'EE01T'},
+                       {'flange_id': '101', 'flange_pos_at_chimney': 'EE01M'} ]}
+
+class StandInHandler(http.server.BaseHTTPRequestHandler):
+    # Answers queries of the form ?dbname=<db>&t=<table>&c=<columns>[&w=<column>:eq:<value>]
+    # with one comma-separated line per matching row, like the hardware database frontend.
+    Requests = list()
+
+    def do_GET(self):
+        Query = urllib.parse.parse_qs(urllib.parse.urlparse(self.path).query)
+        StandInHandler.Requests.append(Query)
+        Rows = TABLES[Query['t'][0]]
+        if 'w' in Query:
+            Column, Operator, Value = Query['w'][0].split(':')
+            Rows = [ Row for Row in Rows if Row[Column] == Value ]
+        Columns = [ x.strip() for x in Query['c'][0].split(',') ]
+        Body = '\n'.join([ ','.join([ Row[x] for x in Columns ]) for Row in Rows ]).encode()
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(Body)))
+        self.end_headers()
+        self.wfile.write(Body)
+
+    def log_message(self, *Args):
+        pass
+
+class StandInQuery:
+    # The query interface of DataLoader3.DataQuery, speaking to the stand-in frontend.
+    def __init__(self, URL):
+        self.URL = URL
+
+    def query(self, Database, Table, Columns, Where=None):
+        Parameters = {'dbname': Database, 't': Table, 'c': Columns}
+        if Where is not None: Parameters['w'] = Where
+        with urllib.request.urlopen(self.URL + '?' + urllib.parse.urlencode(Parameters)) as Response:
+            return Response.read().decode().split('\n')
+
+@pytest.fixture
+def Frontend():
+    Server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), StandInHandler)
+    Thread = threading.Thread(target=Server.serve_forever, daemon=True)
+    Thread.start()
+    StandInHandler.Requests.clear()
+    yield 'http://127.0.0.1:' + str(Server.server_address[1]) + '/query'
+    Server.shutdown()
+    Server.server_close()
+
+def test_MapChannel(Frontend):
+    assert DatabaseTools.MapChannel(64, URL=Frontend, Client=StandInQuery) == ('EE01M', 64)
+
+def test_BuildFullMap(Frontend, tmp_path):
+    # The tables are fetched with one query each and without a 'where' clause. A second
+    # call within MaxAge is served from the cache without any query.
+    Map = DatabaseTools.BuildFullMap(URL=Frontend, CacheDir=str(tmp_path), Client=StandInQuery)
+    assert sorted([ Query['t'][0] for Query in StandInHandler.Requests ]) == ['daq_channels', 'flanges', 'readout_boards']
+    assert all([ 'w' not in Query for Query in StandInHandler.Requests ])
+    assert set(zip(Map.fID, Map.fChannel, Map.fCrate)) == {(0, 0, 'EE01T'), (1, 1, 'EE01T'), (64, 64, 'EE01M')}
+    DatabaseTools.BuildFullMap(URL=Frontend, CacheDir=str(tmp_path), Client=StandInQuery)
+    assert len(StandInHandler.Requests) == 3
+
+def test_BuildMapDataFrame(Frontend, tmp_path):
+    # The map keeps the order of the channel list with one row per channel, despite the
+    # repeated readout board, and channels missing from the database have no crate.
+    ChannelList = [64, 0, 5, 1]
+    DatabaseTools.BuildMapDataFrame(ChannelList, Name=str(tmp_path / 'Map'), URL=Frontend, CacheDir=str(tmp_path), Client=StandInQuery)
+    Map = pd.read_csv(str(tmp_path / 'Map.csv'))
+    assert Map.fID.tolist() == ChannelList
+    assert Map.fCrate.fillna('').tolist() == ['EE01M', 'EE01T', '', 'EE01T']
+
+def test_AlignMap():
+    # A map in another order, with a channel the list doesn't have and missing one it
+    # does, is reordered to one row per channel of the list.
+    Map = pd.DataFrame({'fID': [1, 64, 0, 7], 'fChannel': [1, 64, 0, 7], 'fCrate': ['EE01T', 'EE01M', 'EE01T', 'EE01T']})
+    Aligned = DatabaseTools.AlignMap(Map, [0, 1, 64, 5])
+    assert Aligned.fID.tolist() == [0, 1, 64, 5]
+    assert Aligned.fCrate.fillna('').tolist() == ['EE01T', 'EE01T', 'EE01M', '']
@@ -0,0 +1,81 @@
+import numpy as np
+import pytest
+from RawDigits import RawDigit
+from NoiseCalcTools import NoiseCalc, NoiseAccumulator, PedestalKernel, PedestalRMS, BinOffset, CrateIndex, CorrelationAccumulator
+from SpectraTools import BackgroundSNIP
+from SyntheticTools import SyntheticEvents, SyntheticMap
+
+def test_BandBackground():
+    # The SNIP background of a band-limited spectrum is the same as that of the full
+    # spectrum within the band, even if no padding is asked for: the band is always
+    # padded by the reach of the SNIP iterations.
+    Events = SyntheticEvents(nChannels=128, nTicks=4096, nEvents=1)
+    Frequency, Power = NoiseCalc(RawDigit(Events, 'raw'), True, 1)[1:3]
+    Background = BackgroundSNIP(Power, nIterations=20, ApplyLLS=True)
+    for Band in [(100, 130), (300, 330)]:
+        BandFrequency, BandPower = NoiseCalc(RawDigit(Events, 'raw'), True, 1, Band=Band, Padding=0)[1:3]
+        Offset = BinOffset(BandFrequency)
+        BandBackground = BackgroundSNIP(BandPower, nIterations=20, ApplyLLS=True, Offset=Offset)
+        Bins = np.flatnonzero( (1000*BandFrequency >= Band[0]) & (1000*BandFrequency <= Band[1]) )
+        assert np.allclose(BandBackground[:,Bins], Background[:,Offset+Bins], rtol=1e-10)
+
+@pytest.mark.parametrize('nTicks', [4096, 4095])
+def test_RFFTEngine(nTicks):
+    # The float32 'rfft' engine reproduces the default (density) scaling of the periodogram,
+    # also for an odd number of ticks (no Nyquist bin) and for a BlockSize which doesn't
+    # divide the number of channels. The transform is done in float32, so each bin agrees
+    # to about 1e-4 relative, and the small bins only to 1e-6 of the largest bin.
+    import scipy.signal as signal
+    Generator = np.random.default_rng(4)
+    Events = [ (2048 + Generator.normal(0, 5, (100,nTicks))).astype(np.int16) for Event in range(2) ]
+    Accumulator = NoiseAccumulator(100, nTicks, Engine='rfft', BlockSize=48)
+    for Waveforms in Events: Accumulator.Update(Waveforms)
+    Expected = sum( signal.periodogram(Waveforms, 1/0.4, axis=1, scaling='density')[1] for Waveforms in Events )
+    assert Accumulator.Spectrum.dtype == np.float32
+    assert np.allclose(Accumulator.Frequency, np.fft.rfftfreq(nTicks, 0.4))
+    assert np.allclose(Accumulator.Spectrum, Expected, rtol=2e-4, atol=1e-6*Expected.max())
+    assert np.all(Accumulator.Spectrum[:,0] == 0)
+
+@pytest.mark.parametrize('Waveforms', [
+    np.array([[3, 1, 4, 1, 5, 9, 2, 6], [2, 7, 1, 8, 2, 8, 1, 8]], dtype=np.int16),                  # Even nTicks
+    np.array([[3, 1, 4, 1, 5, 9, 2], [2, 7, 1, 8, 2, 8, 1]], dtype=np.int16),                        # Odd nTicks
+    np.array([[-5, -2, -9, -2, -7, -1], [-3, 4, -1, 0, 2, -4]], dtype=np.int16),                     # Negative values
+    np.array([[2040, 2051, 2049, 2047, 2060], [4095, 4000, 4090, 4093, 4001]], dtype=np.int16),      # Offset values
+    np.full((2,6), 2048, dtype=np.int16),                                                            # Single-valued
+    np.random.default_rng(12).integers(-50, 4096, (64,4096)).astype(np.int16) ])
+def test_PedestalKernel(Waveforms):
+    # The histogram kernel gives the exact median (the mean of the two middle values for
+    # an even number of ticks) and the RMS about it, whatever the range of ADC values.
+    Pedestals, SumSq, RMS = PedestalKernel(Waveforms)
+    Expected = np.median(Waveforms, axis=-1)
+    assert np.array_equal(Pedestals, Expected)
+    Residuals = Waveforms - Expected[:,None]
+    assert np.allclose(SumSq, np.sum(np.square(Residuals), axis=-1), rtol=1e-12)
+    assert np.allclose(RMS, np.sqrt(np.mean(np.square(Residuals), axis=-1)), rtol=1e-12)
+
+def test_CorrelationAccumulator():
+    # The correlation matrix of each crate, from the products of its pedestal-subtracted
+    # waveforms, is that of np.corrcoef over all ticks of all events. The events are split
+    # over two accumulators which are merged (with a third, empty one), as for the worker
+    # processes of NoiseCalc(). The channels are assigned to the crates in a shuffled order.
+    Events = SyntheticEvents(nChannels=1152, nTicks=512, nEvents=4)
+    Map = SyntheticMap(Events)
+    Shuffle = np.random.default_rng(25).permutation(len(Map))
+    Map[['fChannel', 'fCrate']] = Map[['fChannel', 'fCrate']].to_numpy()[Shuffle]
+    Crates = CrateIndex(Map)
+    Partials = [ CorrelationAccumulator(Crates) for i in range(3) ]
+    Subtracted = list()
+    for EventNum, Waveforms in RawDigit(Events, 'raw').IterateWaveforms(4, 1):
+        Pedestals, RMS = PedestalRMS(Waveforms)
+        Partials[EventNum // 2].Update(Waveforms, Pedestals=Pedestals)
+        Subtracted.append(Waveforms - Pedestals[:,None])
+    Correlation = CorrelationAccumulator(Crates)
+    for Partial in Partials: Correlation.Merge(Partial)
+    assert Correlation.N == 4 and Correlation.Ticks == 4*512
+
+    Subtracted = np.concatenate(Subtracted, axis=1)
+    CorrMean = Correlation.Summary()[0]
+    for n, Matrix in enumerate(Correlation.Result()):
+        Expected = np.corrcoef(Subtracted[Crates.Order[Crates.Offsets[n]:Crates.Offsets[n+1]]])
+        assert np.allclose(Matrix, Expected, rtol=1e-10, atol=1e-12)
+        assert np.isclose(CorrMean[n], np.mean(Expected[~np.eye(len(Expected), dtype=bool)]))
@@ -0,0 +1,30 @@
+import numpy as np
+import pytest
+from RawDigits import RawDigit
+from NoiseCalcTools import NoiseAccumulator
+from OnlineTools import OnlineAccumulator
+from SyntheticTools import SyntheticEvents
+
+@pytest.mark.parametrize('Engine', ['periodogram', 'rfft'])
+def test_OnlineAccumulator(Engine):
+    # The running means and the Welford variance of the RMS match the mean and standard
+    # deviation of the per-event metrics, and the metrics of the latest event are left
+    # untouched by the update of the running means.
+    Events = SyntheticEvents(nChannels=256, nTicks=1024, nEvents=5)
+    RawDigits = RawDigit(Events, 'raw')
+    Online = OnlineAccumulator(RawDigits.NumChannels(0), RawDigits.NumTicks(0), Engine=Engine)
+    RMS, Spectra = list(), list()
+    for EventNum, Waveforms in RawDigits.IterateWaveforms(5, 2):
+        Online.Update(Waveforms, BlockSize=100)
+        Event = NoiseAccumulator(*Waveforms.shape, Engine=Engine)
+        Event.Update(Waveforms)
+        RMS.append(Event.RMS)
+        Spectra.append(Event.Spectrum)
+        assert np.array_equal(Online.Event.Spectrum, Event.Spectrum)
+
+    Tolerance = 1e-12 if Engine == 'periodogram' else 1e-6
+    RMSMean, RMSStd, Frequency, Spectrum = Online.Result()
+    assert Online.N == 5
+    assert np.allclose(RMSMean, np.mean(RMS, axis=0), rtol=1e-12)
+    assert np.allclose(RMSStd, np.std(RMS, axis=0, ddof=1), rtol=1e-12)
+    assert np.allclose(Spectrum, np.mean(Spectra, axis=0, dtype=np.float64), rtol=Tolerance, atol=Tolerance*np.max(Spectrum))
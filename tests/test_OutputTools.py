@@ -0,0 +1,18 @@
+import numpy as np
+import pandas as pd
+from OutputTools import WriteMetrics, ReadMetrics
+
+def test_UnmappedChannel(tmp_path):
+    # A channel missing from the hardware database has no mini-crate. It is written to the
+    # store and read back with its mini-crate still missing (not the string 'nan').
+    Frame = pd.DataFrame({'fRun': [7, 7, 7], 'fCrate': ['EE01T', 'EE01T', np.nan], 'fID': [1, 2, 3], 'fRMS': [1.0, 2.0, 3.0]})
+    WriteMetrics(Frame, str(tmp_path), 'ChannelMetrics')
+    Read = ReadMetrics(str(tmp_path), 'ChannelMetrics').sort_values('fID').reset_index(drop=True)
+    pd.testing.assert_frame_equal(Read[Frame.columns], Frame)
+    assert Frame.fCrate.isna().sum() == 1
+
+    # Rewriting the run (now with the channel mapped) leaves no unmapped partition behind.
+    Frame.loc[2, 'fCrate'] = 'EE01T'
+    WriteMetrics(Frame, str(tmp_path), 'ChannelMetrics')
+    Read = ReadMetrics(str(tmp_path), 'ChannelMetrics', Runs=[7])
+    assert len(Read) == 3 and (Read.fCrate == 'EE01T').all()
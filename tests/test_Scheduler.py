@@ -0,0 +1,56 @@
+import os
+import threading
+from Scheduler import RunScheduler
+
+class StubStages:
+    """
+    StubStages: Stand-in decode (Source) and analysis (Process) stages for the RunScheduler. The decode stage creates
+    an empty file, as a substitute for the decode job, and each stage fails for the runs it is told to. The analysis
+    of the Overlap runs waits for the decoding of the next run to start.
+    """
+    def __init__(self, Directory, DecodeFails=(), AnalyzeFails=(), Overlap=()):
+        self.Directory    = Directory
+        self.DecodeFails  = DecodeFails
+        self.AnalyzeFails = AnalyzeFails
+        self.Decoded      = list()
+        self.Analyzed     = list()
+        self.Overlap      = { Run: False for Run in Overlap }
+        self.Started      = { Run: threading.Event() for Run in range(10) }
+
+    def Source(self, Run):
+        self.Decoded.append(Run)
+        self.Started[Run].set()
+        if Run in self.DecodeFails: raise RuntimeError('Decode job failed')
+        File = os.path.join(self.Directory, 'run' + str(Run) + '-decode.root')
+        open(File, 'w').close()
+        return File
+
+    def Process(self, Run, File):
+        # The decoding of the next run is started while this one is analyzed.
+        if Run in self.Overlap: self.Overlap[Run] = self.Started[Run+1].wait(timeout=5)
+        self.Analyzed.append(Run)
+        if Run in self.AnalyzeFails: raise RuntimeError('Analysis failed')
+        return 'Results of run ' + str(Run)
+
+def test_RunScheduler(tmp_path):
+    # Run 2 fails to decode and run 3 fails in the analysis. The other runs are completed,
+    # with the decoding of each run overlapping the analysis of the previous one.
+    StateFile = str(tmp_path / 'SchedulerState.json')
+    Stages = StubStages(str(tmp_path), DecodeFails=[2], AnalyzeFails=[3], Overlap=[1, 3])
+    Scheduler = RunScheduler(Stages.Source, Stages.Process, StateFile=StateFile)
+    Results = Scheduler.Run([1, 2, 3, 4])
+    assert Results == {1: 'Results of run 1', 4: 'Results of run 4'}
+    assert Scheduler.Completed([1, 2, 3, 4]) == [1, 4]
+    assert Scheduler.Failed([1, 2, 3, 4]) == [2, 3]
+    assert Scheduler.State['2']['Stage'] == 'Decode' and Scheduler.State['3']['Stage'] == 'Analyze'
+    assert Stages.Decoded == [1, 2, 3, 4] and Stages.Analyzed == [1, 3, 4]
+    assert Stages.Overlap == {1: True, 3: True}
+
+    # A second scheduler on the same state file skips the completed runs, decodes run 2
+    # again, and analyzes run 3 from its existing decoded file.
+    Stages = StubStages(str(tmp_path))
+    Scheduler = RunScheduler(Stages.Source, Stages.Process, StateFile=StateFile)
+    Results = Scheduler.Run([1, 2, 3, 4])
+    assert Results == {2: 'Results of run 2', 3: 'Results of run 3'}
+    assert Scheduler.Completed([1, 2, 3, 4]) == [1, 2, 3, 4]
+    assert Stages.Decoded == [2] and Stages.Analyzed == [2, 3]